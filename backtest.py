@@ -0,0 +1,164 @@
+"""Backtests the rating constants: replays the full game history under a grid of (C, MIN_K, MAX_K, K_NUMERATOR)
+parameter sets and scores each set by how well the ratings before every game predicted its pairwise results
+(log-loss, Brier score and accuracy). All the sets in a chunk are replayed together, as a leading array axis, from
+arrays prepared once, and the chunks are spread across a process pool, e.g.
+python backtest.py --db sqlite:///tm_data.db --c 300,400,500 --min-k 16,32 --max-k 150,200,300"""
+import argparse
+from functools import partial
+from itertools import groupby, product
+import os
+import time
+
+import numpy as np
+
+from constants import (C, MIN_K, MAX_K, K_NUMERATOR, STARTING_RATING, BACKTEST_GRID, BACKTEST_CHUNK_SIZE,
+                       BACKTEST_POOL_WORKERS)
+from elo import expected_matrix, winloss_matrix, calculate_batch_ratings, pad_games, split_disjoint
+from pools import spawn_pool
+
+PARAMETERS = ["c", "min_k", "max_k", "k_numerator"]
+CURRENT_PARAMETERS = (C, MIN_K, MAX_K, K_NUMERATOR)
+PROBABILITY_EPSILON = 1e-12  # Keeps log-loss finite for (near) certain predictions
+
+
+def backtest_batches(game_entries, player_ids):
+    """Returns the padded (players, scores, mask) arrays of each batch of games with disjoint players, in play
+    order, with players as indices into <player_ids>. Game entries are as returned by get_game_entries"""
+    index = {player_id: i for i, player_id in enumerate(player_ids)}
+    batches = []
+    for round_num, round_entries in groupby(game_entries, key=lambda entry: entry.round):
+        games = [list(entries) for game_id, entries in groupby(round_entries, key=lambda entry: entry.game_id)]
+        for batch in split_disjoint(games, key=lambda entry: entry.player_id):
+            players, mask = pad_games([[index[entry.player_id] for entry in game] for game in batch])
+            scores, _ = pad_games([[entry.score for entry in game] for game in batch])
+            batches.append((players, scores, mask))
+    return batches
+
+
+def load_batches(db):
+    """Returns (batches, number of players) for the league's full history"""
+    from database_manager import get_game_entries, get_player_ids
+
+    player_ids = get_player_ids(db)
+    return backtest_batches(get_game_entries(db), player_ids), len(player_ids)
+
+
+def backtest(batches, num_players, parameter_sets):
+    """Replays the batches under every (c, min_k, max_k, k_numerator) set at once. Each pair of players in a game
+    is scored on its expected result from the ratings before the game.
+    Returns a list of {"log_loss", "brier", "accuracy"} dicts (means per pair), one per set"""
+    c, min_k, max_k, k_numerator = (np.array(values, dtype=float)[:, np.newaxis, np.newaxis]
+                                    for values in zip(*parameter_sets))
+    ratings = np.full((len(parameter_sets), num_players), STARTING_RATING, dtype=int)
+    num_games = np.zeros(num_players, dtype=int)
+    log_loss, brier, correct = (np.zeros(len(parameter_sets)) for i in range(3))
+    num_pairs = 0
+
+    for players, scores, mask in batches:
+        old_ratings = ratings[:, players]
+
+        # Score the predictions for each pair (once per pair)
+        pairs = np.triu(mask[:, :, np.newaxis] & mask[:, np.newaxis, :], k=1)
+        actual = winloss_matrix(scores)[pairs]
+        expected = np.clip(expected_matrix(old_ratings, c)[:, pairs], PROBABILITY_EPSILON, 1 - PROBABILITY_EPSILON)
+        log_loss -= (actual * np.log(expected) + (1 - actual) * np.log(1 - expected)).sum(axis=1)
+        brier += ((expected - actual) ** 2).sum(axis=1)
+        # A draw, or a prediction of exactly 0.5, counts as half right
+        correct += np.where((actual == 0.5) | (expected == 0.5), 0.5, (expected > 0.5) == (actual == 1)).sum(axis=1)
+        num_pairs += len(actual)
+
+        new_ratings = calculate_batch_ratings(scores, old_ratings, num_games[players], mask, c=c, min_k=min_k,
+                                              max_k=max_k, k_numerator=k_numerator)
+        ratings[:, players[mask]] = new_ratings[:, mask]
+        num_games[players[mask]] += 1
+
+    num_pairs = max(num_pairs, 1)
+    return [{"log_loss": float(log_loss[i] / num_pairs), "brier": float(brier[i] / num_pairs),
+             "accuracy": float(correct[i] / num_pairs)} for i in range(len(parameter_sets))]
+
+
+def parameter_grid(cs, min_ks, max_ks, k_numerators):
+    """Returns every (c, min_k, max_k, k_numerator) combination with min_k <= max_k, plus the current constants"""
+    grid = [parameters for parameters in product(cs, min_ks, max_ks, k_numerators) if parameters[1] <= parameters[2]]
+    if CURRENT_PARAMETERS not in grid:
+        grid.append(CURRENT_PARAMETERS)
+    return grid
+
+
+def run_sweep(batches, num_players, parameter_sets, max_workers=BACKTEST_POOL_WORKERS, progress=None):
+    """Backtests every parameter set in chunks of at most BACKTEST_CHUNK_SIZE sets, spread across a process pool
+    when there is more than one core. <progress>, if given, is called with (sets done, total sets) as the chunks
+    finish. Returns a list of result dicts (the parameters, scores and whether they are the current constants)
+    sorted by log-loss"""
+    max_workers = max_workers or os.cpu_count()
+    num_chunks = max(min(max_workers, len(parameter_sets)), -(-len(parameter_sets) // BACKTEST_CHUNK_SIZE))
+    chunks = [chunk for chunk in np.array_split(np.array(parameter_sets, dtype=float), num_chunks) if len(chunk)]
+    run_chunk = partial(backtest, batches, num_players)
+    if max_workers == 1 or len(chunks) == 1:
+        scores = collect_chunks(chunks, map(run_chunk, chunks), progress)
+    else:
+        with spawn_pool(min(max_workers, len(chunks))) as pool:
+            scores = collect_chunks(chunks, pool.map(run_chunk, chunks), progress)
+
+    results = [{**dict(zip(PARAMETERS, parameters)), **score, "current": tuple(parameters) == CURRENT_PARAMETERS}
+               for parameters, score in zip(parameter_sets, (score for chunk in scores for score in chunk))]
+    return sorted(results, key=lambda result: result["log_loss"])
+
+
+def collect_chunks(chunks, chunk_scores, progress=None):
+    """Returns the list of each chunk's scores, reporting (sets done, total sets) to <progress> as they arrive"""
+    scores, sets_done, num_sets = [], 0, sum(len(chunk) for chunk in chunks)
+    for chunk, score in zip(chunks, chunk_scores):
+        scores.append(score)
+        sets_done += len(chunk)
+        if progress is not None:
+            progress(sets_done, num_sets)
+    return scores
+
+
+def parse_values(text):
+    """Returns the numbers in a comma-separated string, e.g. "300, 400.5" -> [300, 400.5]"""
+    values = [float(value) for value in text.split(",") if value.strip()]
+    return [int(value) if value.is_integer() else value for value in values]
+
+
+def format_results(results, top=None):
+    """Returns the results as a text table, best first"""
+    lines = [f"{'C':>7} {'MIN_K':>6} {'MAX_K':>6} {'K_NUM':>6} {'log-loss':>9} {'Brier':>7} {'accuracy':>8}"]
+    for result in results[:top]:
+        lines.append(f"{result['c']:>7g} {result['min_k']:>6g} {result['max_k']:>6g} {result['k_numerator']:>6g} "
+                     f"{result['log_loss']:>9.5f} {result['brier']:>7.5f} {result['accuracy']:>8.2%}"
+                     + ("  (current)" if result["current"] else ""))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest a grid of rating constants against the game history")
+    parser.add_argument("--db", default=os.environ.get("DB_URI", "sqlite:///tm_data.db"),
+                        help="database URI (SQLite or Postgres), default $DB_URI or sqlite:///tm_data.db")
+    for parameter, flag in zip(PARAMETERS, ["--c", "--min-k", "--max-k", "--k-numerator"]):
+        parser.add_argument(flag, type=parse_values, default=BACKTEST_GRID[parameter],
+                            help=f"comma-separated values, default {','.join(map(str, BACKTEST_GRID[parameter]))}")
+    parser.add_argument("--workers", type=int, default=BACKTEST_POOL_WORKERS, help="processes (default all cores)")
+    parser.add_argument("--top", type=int, default=20, help="number of results to print (default 20)")
+    args = parser.parse_args()
+
+    # The app reads its database from the environment when it is imported
+    os.environ["DB_URI"] = args.db
+    from main import app
+    from database_manager import db
+
+    with app.app_context():
+        batches, num_players = load_batches(db)
+    grid = parameter_grid(args.c, args.min_k, args.max_k, args.k_numerator)
+    start = time.perf_counter()
+    results = run_sweep(batches, num_players, grid, args.workers)
+    print(f"{len(grid)} parameter sets backtested over {len(batches)} batches in {time.perf_counter() - start:.2f}s\n")
+    print(format_results(results, args.top))
+    current = next(result for result in results if result["current"])
+    if current not in results[:args.top]:
+        print(f"...\n{format_results([current]).splitlines()[1]}  (rank {results.index(current) + 1})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""Times the Elo functions, the database helpers, the league snapshot and the public routes against a (synthetic)
+league, counts the SQL queries each one runs and compares the results with a saved JSON baseline, e.g.
+python benchmark.py --db sqlite:///bench.db --generate --reset --save     (generate a league and save a baseline)
+python benchmark.py --db sqlite:///bench.db                               (report regressions against the baseline)"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import event, func
+
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+
+class QueryCounter:
+    """Counts the SQL statements run on an engine while active"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._count)
+
+
+def measure(engine, func, repeat):
+    """Runs <func> once cold and <repeat> times warm. Returns the timings in ms and query counts"""
+    with QueryCounter(engine) as counter:
+        start = time.perf_counter()
+        func()
+        cold_ms = (time.perf_counter() - start) * 1000
+    queries = counter.count
+
+    timings = []
+    for i in range(repeat):
+        with QueryCounter(engine) as counter:
+            start = time.perf_counter()
+            func()
+            timings.append((time.perf_counter() - start) * 1000)
+    return {"cold_ms": round(cold_ms, 3), "median_ms": round(statistics.median(timings), 3),
+            "min_ms": round(min(timings), 3), "queries": queries, "warm_queries": counter.count}
+
+
+# Benchmarks
+def elo_benchmarks(db):
+    """Returns {name: function} timing the rating code, from the pure functions to a full recalculation"""
+    from database_manager import get_game_entries, get_player_ids, get_faction_ids
+    from elo import calculate_new_ratings, calculate_batch_ratings, pad_games, replay_games, recalculate_elos
+    from simulation import count_places
+
+    rng = np.random.default_rng(0)
+    game_scores = rng.integers(60, 200, size=4)
+    game_ratings = rng.integers(800, 1300, size=4)
+    game_num_games = rng.integers(0, 100, size=4)
+    batch = [list(rng.integers(60, 200, size=size)) for size in rng.choice([3, 4, 5], size=100)]
+    batch_scores, batch_mask = pad_games(batch)
+    batch_ratings = np.where(batch_mask, rng.integers(800, 1300, size=batch_mask.shape), 0)
+    batch_num_games = np.where(batch_mask, rng.integers(0, 100, size=batch_mask.shape), 0)
+    game_entries = get_game_entries(db)
+    player_ids, faction_ids = get_player_ids(db), get_faction_ids(db)
+    latest_round = game_entries[-1].round
+    round_ratings, round_mask = pad_games([list(rng.integers(800, 1300, size=4)) for group in "ABC"])
+
+    return {
+        "elo.calculate_new_ratings x1000": lambda: [calculate_new_ratings(game_scores, game_ratings, game_num_games)
+                                                    for i in range(1000)],
+        "elo.calculate_batch_ratings (100 games)": lambda: calculate_batch_ratings(batch_scores, batch_ratings,
+                                                                                   batch_num_games, batch_mask),
+        "elo.replay_games (in memory)": lambda: replay_games(game_entries, player_ids, faction_ids),
+        "elo.recalculate_elos (full)": lambda: recalculate_elos(db),
+        "elo.recalculate_elos (latest round)": lambda: recalculate_elos(db, from_round=latest_round),
+        "simulation.count_places (100k rounds of 3 games)": lambda: count_places(round_ratings, round_mask, 100_000, 0),
+    }
+
+
+def helper_benchmarks(db, player_name, faction_name):
+    """Returns {name: function} timing the database helpers that still run in production (the version check, the
+    replay's reads, the snapshot load) and the snapshot's build steps and read methods behind the public pages"""
+    import database_manager as dm
+    from faction_analytics import FactionAnalytics
+    from game_columns import GameColumns, player_stats_table
+    from snapshot import LeagueSnapshot, load_snapshot
+
+    game_entries = dm.get_game_entries(db)
+    latest_round = game_entries[-1].round
+    version, rows = dm.get_snapshot_rows(db)
+    columns = GameColumns(dm.get_history_rows(db), dm.get_player_ids(db), dm.get_faction_ids(db))
+    faction_names = db.session.execute(db.select(dm.Faction.name).order_by(dm.Faction.id)).scalars().all()
+    snapshot = LeagueSnapshot(version, rows)
+    player = snapshot.players[player_name]
+    return {
+        "dm.get_league_version": lambda: dm.get_league_version(db),
+        "dm.get_player_data": lambda: dm.get_player_data(db),
+        "dm.get_latest_lineups": lambda: dm.get_latest_lineups(db),
+        "dm.get_player_ids": lambda: dm.get_player_ids(db),
+        "dm.get_faction_ids": lambda: dm.get_faction_ids(db),
+        "dm.get_game_entries": lambda: dm.get_game_entries(db),
+        "dm.get_game_entries (latest round)": lambda: dm.get_game_entries(db, after_round=latest_round - 1),
+        "dm.get_checkpoint_round": lambda: dm.get_checkpoint_round(db, latest_round),
+        "dm.get_rating_checkpoint": lambda: dm.get_rating_checkpoint(db, latest_round - 1),
+        "dm.get_faction_checkpoint": lambda: dm.get_faction_checkpoint(db, latest_round - 1),
+        "dm.get_history_rows": lambda: dm.get_history_rows(db),
+        "dm.get_snapshot_rows": lambda: dm.get_snapshot_rows(db),
+        "gc.GameColumns": lambda: GameColumns(dm.get_history_rows(db), dm.get_player_ids(db), dm.get_faction_ids(db)),
+        "gc.player_stats_table (all players)": lambda: player_stats_table(columns),
+        "fa.FactionAnalytics": lambda: FactionAnalytics(columns, faction_names),
+        "snapshot.LeagueSnapshot (from rows)": lambda: LeagueSnapshot(version, rows),
+        "snapshot.load_snapshot": lambda: load_snapshot(db),
+        "snapshot.get_leaderboard": lambda: snapshot.get_leaderboard(),
+        "snapshot.get_latest_results": lambda: snapshot.get_latest_results(),
+        "snapshot.get_movers": lambda: snapshot.get_movers(5),
+        "snapshot.get_results_page": lambda: snapshot.get_results_page(latest_round - 9, latest_round),
+        "snapshot.get_profile_data": lambda: snapshot.get_profile_data(player_name),
+        "snapshot.get_head_to_head_record": lambda: snapshot.get_head_to_head_record(player),
+        "snapshot.get_all_rating_histories": lambda: snapshot.get_all_rating_histories(),
+        "snapshot.get_standings": lambda: snapshot.get_standings(latest_round),
+        "snapshot.get_faction_leaderboard": lambda: snapshot.get_faction_leaderboard(),
+        "snapshot.get_faction_rating_history": lambda: snapshot.get_faction_rating_history(faction_name),
+        "snapshot.faction_analytics.query": lambda: snapshot.faction_analytics.query(),
+    }
+
+
+def route_benchmarks(client, player_name, faction_name):
+    """Returns {name: function} requesting each public page through the test client. The first (cold) request
+    fills the per-worker caches, so warm timings show the cached path"""
+    def get(url):
+        def request():
+            response = client.get(url)
+            response.close()
+            if response.status_code != 200:
+                raise RuntimeError(f"GET {url} returned {response.status_code}")
+        return request
+
+    return {f"route {url}": get(url) for url in [
+        "/", "/results", "/results/page/1", f"/profile/{player_name}", "/head-to-head", "/api/head-to-head",
+        "/api/rating-history", "/odds", "/factions", "/factions/analytics", "/factions/analytics?map=Base+Game&group=A&first_round=2",
+        "/rating-system", f"/get-rating-plot/{player_name}", f"/get-faction-plot/{faction_name}"]}
+
+
+def run_benchmarks(app, db, repeat, groups):
+    """Runs the benchmark groups and returns (metadata, {name: result})"""
+    from database_manager import Player, Faction, Game, GameHistory
+
+    with app.app_context():
+        counts = {model.__tablename__: db.session.execute(db.select(func.count()).select_from(model)).scalar()
+                  for model in [Player, Faction, Game, GameHistory]}
+        if not counts["game_history"]:
+            raise SystemExit("The database has no games, run with --generate first")
+        player_names = db.session.execute(db.select(Player.name).order_by(Player.current_rating.desc())).scalars().all()
+        player_name = player_names[len(player_names) // 2]
+        faction_name = db.session.execute(db.select(Faction.name).order_by(Faction.name)).scalars().first()
+
+    results = {}
+    with app.app_context():
+        metadata = {"date": dt.datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+                    "dialect": db.engine.dialect.name, "repeat": repeat, "counts": counts}
+        benchmarks = {}
+        if "elo" in groups:
+            benchmarks.update(elo_benchmarks(db))
+        if "helpers" in groups:
+            benchmarks.update(helper_benchmarks(db, player_name, faction_name))
+        for name, benchmark in benchmarks.items():
+            results[name] = measure(db.engine, benchmark, repeat)
+            db.session.rollback()
+            print(format_result(name, results[name]), flush=True)
+        if "routes" in groups:
+            for name, benchmark in route_benchmarks(app.test_client(), player_name, faction_name).items():
+                results[name] = measure(db.engine, benchmark, repeat)
+                print(format_result(name, results[name]), flush=True)
+    return metadata, results
+
+
+def format_result(name, result):
+    return (f"{name:<48} cold {result['cold_ms']:>10.2f} ms  median {result['median_ms']:>10.2f} ms  "
+            f"queries {result['queries']:>4} / {result['warm_queries']:<4}")
+
+
+# Regression report
+def compare(baseline, results, tolerance, min_delta_ms):
+    """Returns (regressions, improvements) as lists of messages. A timing regresses if it is more than
+    <tolerance> (a fraction) and <min_delta_ms> slower than the baseline, a query count if it goes up at all"""
+    regressions, improvements = [], []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in ["cold_ms", "median_ms"]:
+            change = result[metric] - base[metric]
+            message = f"{name} {metric}: {base[metric]:.2f} -> {result[metric]:.2f} ms"
+            if abs(change) > max(base[metric] * tolerance, min_delta_ms):
+                (regressions if change > 0 else improvements).append(
+                    f"{message} ({change / base[metric]:+.0%})" if base[metric] else message)
+        for metric in ["queries", "warm_queries"]:
+            if result[metric] != base[metric]:
+                (regressions if result[metric] > base[metric] else improvements).append(
+                    f"{name} {metric}: {base[metric]} -> {result[metric]}")
+    return regressions, improvements
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the league against a JSON baseline")
+    parser.add_argument("--db", default=os.environ.get("DB_URI", "sqlite:///bench.db"),
+                        help="database URI (SQLite or Postgres), default $DB_URI or sqlite:///bench.db")
+    parser.add_argument("--generate", action="store_true", help="replace the league data with a synthetic league")
+    parser.add_argument("--reset", action="store_true", help="required with --generate, which replaces all league data")
+    parser.add_argument("--players", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--entries", type=int, default=50_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5, help="warm runs per benchmark")
+    parser.add_argument("--only", nargs="+", choices=["elo", "helpers", "routes"], default=["elo", "helpers", "routes"])
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown as a fraction")
+    parser.add_argument("--min-delta-ms", type=float, default=5, help="ignore timing changes smaller than this")
+    args = parser.parse_args()
+    if args.generate and not args.reset:
+        parser.error(f"--generate replaces all league data in {args.db}, pass --reset to confirm")
+
+    # The app reads its database from the environment when it is imported
+    os.environ["DB_URI"] = args.db
+    from main import app
+    from database_manager import db
+    from synthetic_league import generate_league
+
+    if args.generate:
+        with app.app_context():
+            num_games, num_entries = generate_league(db, args.players, args.rounds, args.entries, args.seed)
+        print(f"Generated {args.players} players, {args.rounds} rounds, {num_games} games, {num_entries} entries")
+
+    metadata, results = run_benchmarks(app, db, args.repeat, args.only)
+
+    if args.save:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({"metadata": metadata, "results": results}, baseline_file, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save to create one")
+        return
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline["metadata"]["counts"] != metadata["counts"]:
+        print(f"Warning: the baseline was run on a different league {baseline['metadata']['counts']}")
+    regressions, improvements = compare(baseline["results"], results, args.tolerance, args.min_delta_ms)
+    print(f"\n{len(improvements)} improvements")
+    for message in improvements:
+        print(f"  {message}")
+    print(f"{len(regressions)} regressions")
+    for message in regressions:
+        print(f"  {message}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
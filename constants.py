@@ -3,10 +3,52 @@ STARTING_RATING = 1000
 C = 400
 MIN_K = 32
 MAX_K = 200
+K_NUMERATOR = 800  # K is K_NUMERATOR / (games played + 1), clamped to [MIN_K, MAX_K]
 
 # Profiles related
 RATING_FIG_YRANGE = (300, 1710, 100)  # (y-min, y-max, increment)
 HIGH_RATING_THRESHOLD = 10
+RESULTS_ROUNDS_PER_PAGE = 10  # Rounds per page of /results. Pages are fixed round ranges, so old pages stay cached
+MOVERS_COUNT = 5  # Biggest risers and fallers of the latest round shown on the home page
+PLOT_CACHE_SIZE = 200  # Max number of rendered rating plots kept in memory per worker
+PLOT_POOL_WORKERS = None  # Plot rendering processes per worker (None = number of cores)
+PLOT_BACKGROUND_WORKERS = 1  # Processes per worker for refilling the plot cache, apart from the request renders
+PLOT_QUEUE_LIMIT = 8  # Max plots rendering or waiting to render per worker before serving a placeholder
+PLOT_RENDER_TIMEOUT = 5  # Seconds a request waits for its plot before serving a placeholder
+
+# Bulk writes
+BULK_CHUNK_SIZE = 5000  # Rows per UPDATE ... FROM (VALUES ...) statement on Postgres
+BULK_COPY_MIN_ROWS = 10_000  # Inserts of at least this many rows use COPY on Postgres
+
+# Recalculation jobs
+RECALCULATION_STALE_AFTER = 600  # Seconds without a heartbeat after which an active job is treated as abandoned
+RECALCULATION_ATTEMPTS = 3  # Times a job reruns if the league data changes while it is running
+JOB_PROGRESS_INTERVAL = 0.5  # Min seconds between progress writes to the job record
+
+# Instrumentation related
+SLOW_QUERY_MS = 200  # SQL statements slower than this are logged
+N_PLUS_ONE_THRESHOLD = 20  # The same statement run more than this many times in one request is flagged as N+1
+METRICS_RECENT_LIMIT = 50  # Number of recent slow queries and N+1 flags kept per worker
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Next-round forecast
+SIMULATIONS = 100_000  # Simulated rounds behind the odds page
+SIMULATION_BATCH_SIZE = 10_000  # Simulations sampled at once, which bounds the memory a run uses
+SIMULATION_POOL_WORKERS = None  # Simulation processes per worker (None = number of cores)
+SIMULATION_PARALLEL_THRESHOLD = 500_000  # Runs with more simulations than this are split across the process pool
+
+# Backtesting (backtest.py and the admin backtest page)
+BACKTEST_GRID = {  # Default values swept for each rating constant
+    "c": [200, 300, 400, 500, 600],
+    "min_k": [16, 24, 32, 48],
+    "max_k": [100, 150, 200, 300],
+    "k_numerator": [400, 600, 800, 1000, 1200],
+}
+BACKTEST_CHUNK_SIZE = 50  # Max parameter sets replayed together, which bounds the memory a replay uses
+BACKTEST_POOL_WORKERS = None  # Backtest processes (None = number of cores)
+BACKTEST_MAX_SETS = 5000  # Largest grid the admin page will run (as a background job)
+BACKTEST_STALE_AFTER = 600  # Seconds without a heartbeat after which an active backtest is treated as abandoned
 
 # Emojis
 EMOJIS = {
@@ -15,6 +57,13 @@ EMOJIS = {
     "C": {1: "🎉", 2: "⬆️", 3:"⬇️", 4:"💩"}
 }
 
+# Finishing places (as numbered in EMOJIS) that win the title, move a player up a group or move them down a group
+GROUP_MOVES = {
+    "A": {"title": [1], "up": [], "down": [4]},
+    "B": {"title": [], "up": [1, 2], "down": [3, 4]},
+    "C": {"title": [], "up": [1, 2], "down": [3, 4]},
+}
+
 # add-game Form information
 MAPS = [
     ("Base Game", "Base Game"),
@@ -1,12 +1,17 @@
 import datetime as dt
-from statistics import mean
-from typing import List
+import io
+from itertools import groupby
+from typing import List, Optional
 
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Integer, String, DateTime, ForeignKey, func
+from sqlalchemy import (Integer, String, Text, DateTime, Boolean, ForeignKey, Index, func, update, delete,
+                        insert, bindparam, event, values, column, cast)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
 
+from constants import BULK_CHUNK_SIZE, BULK_COPY_MIN_ROWS, EMOJIS
+
 
 # Create database
 class Base(DeclarativeBase):
@@ -24,6 +29,7 @@ class User(UserMixin, db.Model):
 
 class Player(db.Model):
     __tablename__ = "player"
+    __table_args__ = (Index("ix_player_current_rating", "current_rating"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String(50), unique=True, nullable=False)
     current_rating: Mapped[int] = mapped_column(Integer, nullable=False)
@@ -41,6 +47,7 @@ class Faction(db.Model):
 
 class Game(db.Model):
     __tablename__ = "game"
+    __table_args__ = (Index("ix_game_round_group", "round", "group", "bga_id"),)
     bga_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     round: Mapped[int] = mapped_column(Integer, nullable=False)
     group: Mapped[str] = mapped_column(String(10), nullable=False)
@@ -52,6 +59,11 @@ class Game(db.Model):
 # Association table
 class GameHistory(db.Model):
     __tablename__ = "game_history"
+    __table_args__ = (
+        Index("ix_game_history_player_id_game_id", "player_id", "game_id"),
+        Index("ix_game_history_game_id_score", "game_id", "score"),
+        Index("ix_game_history_faction_id", "faction_id"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     player_id: Mapped[int] = mapped_column(db.ForeignKey("player.id"))
     faction_id: Mapped[int] = mapped_column(db.ForeignKey("faction.id"))
@@ -66,7 +78,268 @@ class GameHistory(db.Model):
     created_at: Mapped[dt.datetime] = mapped_column(DateTime, nullable=False)
 
 
+# Snapshot of every player's rating, game count and rank at the end of each round (the standings as of that round)
+class RatingCheckpoint(db.Model):
+    __tablename__ = "rating_checkpoint"
+    round: Mapped[int] = mapped_column(Integer, primary_key=True)
+    player_id: Mapped[int] = mapped_column(db.ForeignKey("player.id"), primary_key=True)
+    rating: Mapped[int] = mapped_column(Integer, nullable=False)
+    num_games: Mapped[int] = mapped_column(Integer, nullable=False)
+    rank: Mapped[Optional[int]] = mapped_column(Integer)  # None until the player's first game
+    rating_change: Mapped[Optional[int]] = mapped_column(Integer)  # Since the end of the previous round
+
+
+# Snapshot of every faction's rating and game count at the end of each round
+class FactionCheckpoint(db.Model):
+    __tablename__ = "faction_checkpoint"
+    __table_args__ = (Index("ix_faction_checkpoint_faction_id_round", "faction_id", "round"),)
+    round: Mapped[int] = mapped_column(Integer, primary_key=True)
+    faction_id: Mapped[int] = mapped_column(db.ForeignKey("faction.id"), primary_key=True)
+    rating: Mapped[int] = mapped_column(Integer, nullable=False)
+    num_games: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+# Single row counting writes to the league data, used to validate caches across workers
+class LeagueVersion(db.Model):
+    __tablename__ = "league_version"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False)
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime, nullable=False)  # UTC
+
+
+# The rounds whose results (entry ratings) each replay rewrote, so pages of old results stay cached until a replay
+# reaches them. Rounds after <after_round> were rewritten at league <version> (all rounds if NULL)
+class ResultsRevision(db.Model):
+    __tablename__ = "results_revision"
+    version: Mapped[int] = mapped_column(Integer, primary_key=True)
+    after_round: Mapped[Optional[int]] = mapped_column(Integer)
+
+
+# Background rating recalculations (see jobs.py). <active> is True while queued or running and NULL once finished, so
+# the unique index allows only one active job across all workers
+class RecalculationJob(db.Model):
+    __tablename__ = "recalculation_job"
+    __table_args__ = (Index("uq_recalculation_job_active", "active", unique=True),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    status: Mapped[str] = mapped_column(String(20), nullable=False)  # queued, running, succeeded or failed
+    active: Mapped[Optional[bool]] = mapped_column(Boolean)
+    from_round: Mapped[Optional[int]] = mapped_column(Integer)
+    rounds_done: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    rounds_total: Mapped[Optional[int]] = mapped_column(Integer)
+    error: Mapped[Optional[str]] = mapped_column(String(500))
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime, nullable=False)  # UTC, like the timestamps below
+    started_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime)
+    finished_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime)
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime, nullable=False)  # Heartbeat while running
+
+
+# Background backtests of the rating constants (see jobs.py), one active at a time like recalculations. <results> is the
+# sweep's result list as JSON, so every worker can show it
+class BacktestJob(db.Model):
+    __tablename__ = "backtest_job"
+    __table_args__ = (Index("uq_backtest_job_active", "active", unique=True),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    status: Mapped[str] = mapped_column(String(20), nullable=False)  # queued, running, succeeded or failed
+    active: Mapped[Optional[bool]] = mapped_column(Boolean)
+    grid_size: Mapped[int] = mapped_column(Integer, nullable=False)
+    sets_done: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    league_version: Mapped[Optional[int]] = mapped_column(Integer)  # Version of the history it replayed
+    results: Mapped[Optional[str]] = mapped_column(Text)
+    error: Mapped[Optional[str]] = mapped_column(String(500))
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime, nullable=False)  # UTC, like the timestamps below
+    started_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime)
+    finished_at: Mapped[Optional[dt.datetime]] = mapped_column(DateTime)
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime, nullable=False)  # Heartbeat while running
+
+
+# Single row recording the last migration applied (see migrations.py)
+class SchemaVersion(db.Model):
+    __tablename__ = "schema_version"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False)
+
+
+# Engine configuration
+def engine_options(environ):
+    """Returns SQLAlchemy engine options from the DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE (seconds) and
+    DB_POOL_PRE_PING (1 or 0) environment variables, leaving SQLAlchemy's default for any that aren't set"""
+    options = {option: int(environ[variable]) for variable, option in [("DB_POOL_SIZE", "pool_size"),
+                                                                       ("DB_MAX_OVERFLOW", "max_overflow"),
+                                                                       ("DB_POOL_RECYCLE", "pool_recycle")]
+               if environ.get(variable)}
+    if environ.get("DB_POOL_PRE_PING"):
+        options["pool_pre_ping"] = environ["DB_POOL_PRE_PING"].lower() in ("1", "true", "yes")
+    return options
+
+
+def configure_sqlite(engine):
+    """Puts SQLite databases in WAL mode, so page reads aren't blocked while a recalculation writes and commits"""
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect",
+                     lambda dbapi_connection, connection_record: dbapi_connection.execute("PRAGMA journal_mode=WAL"))
+
+
+# Bulk writes
+def bulk_update_rows(db, model, rows, key="id"):
+    """Updates a table from a list of row dicts (<key> plus the columns to set, the same in every row) in the
+    current transaction. On Postgres each BULK_CHUNK_SIZE rows are one UPDATE ... FROM (VALUES ...) statement,
+    elsewhere they are an executemany of UPDATE ... WHERE <key> = ?"""
+    if not rows:
+        return
+    table = model.__table__
+    columns = [name for name in rows[0] if name != key]
+    if db.session.get_bind().dialect.name == "postgresql":
+        for start in range(0, len(rows), BULK_CHUNK_SIZE):
+            new_values = (values(*[column(name, table.c[name].type) for name in [key] + columns], name="new_values")
+                          .data([tuple(row[name] for name in [key] + columns)
+                                 for row in rows[start:start + BULK_CHUNK_SIZE]]))
+            # The casts type the VALUES columns, which would be text if a chunk's values were all NULL
+            db.session.execute(update(table)
+                               .where(table.c[key] == cast(new_values.c[key], table.c[key].type))
+                               .values({name: cast(new_values.c[name], table.c[name].type) for name in columns}))
+    else:
+        db.session.execute(update(table)
+                           .where(table.c[key] == bindparam(f"b_{key}"))
+                           .values({name: bindparam(f"b_{name}") for name in columns}),
+                           [{f"b_{name}": value for name, value in row.items()} for row in rows])
+
+
+def bulk_insert_rows(db, model, rows):
+    """Inserts a list of row dicts (the same columns in every row) in the current transaction. On Postgres,
+    BULK_COPY_MIN_ROWS or more rows are streamed in with COPY (so every column without a server default must be
+    given); otherwise it is an executemany, which SQLAlchemy sends as multi-row INSERTs"""
+    if not rows:
+        return
+    if db.session.get_bind().dialect.name == "postgresql" and len(rows) >= BULK_COPY_MIN_ROWS:
+        db.session.flush()
+        connection = db.session.connection()
+        quote = connection.dialect.identifier_preparer.quote
+        names = list(rows[0])
+        data = io.StringIO("".join("\t".join(copy_value(row[name]) for name in names) + "\n" for row in rows))
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(f"COPY {quote(model.__tablename__)} ({', '.join(map(quote, names))}) FROM STDIN",
+                               data)
+        finally:
+            cursor.close()
+    else:
+        db.session.execute(insert(model), rows)
+
+
+def copy_value(value):
+    """Returns a value in COPY's text format"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, dt.datetime):
+        value = value.isoformat(sep=" ")
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
 # Functions for interacting with database
+def init_league_version(db):
+    """Creates the league version row if it doesn't exist yet"""
+    if db.session.get(LeagueVersion, 1) is None:
+        db.session.add(LeagueVersion(id=1, version=1, updated_at=utc_now()))
+        try:
+            db.session.commit()
+        except IntegrityError:  # Another worker created it first
+            db.session.rollback()
+
+
+def get_league_version(db):
+    """Returns (version, updated_at) of the league data"""
+    return tuple(db.session.execute(db.select(LeagueVersion.version, LeagueVersion.updated_at)
+                                    .where(LeagueVersion.id == 1)).one())
+
+
+def bump_league_version(db, expected_version=None):
+    """Increments the league version in the current transaction, so it is published with the write it belongs to.
+    If <expected_version> is given, only increments it from that version. Returns whether it was incremented"""
+    query = update(LeagueVersion).where(LeagueVersion.id == 1)
+    if expected_version is not None:
+        query = query.where(LeagueVersion.version == expected_version)
+    return db.session.execute(query.values(version=LeagueVersion.version + 1, updated_at=utc_now())).rowcount == 1
+
+
+def record_results_revision(db, after_round):
+    """Records in the current transaction that the results of rounds after <after_round> (all if None) were rewritten
+    at the (already bumped) league version"""
+    db.session.add(ResultsRevision(version=get_league_version(db)[0], after_round=after_round))
+
+
+def utc_now():
+    """Returns the current UTC time as a naive datetime"""
+    return dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+
+
+# Background jobs
+def create_job(db, model, stale_after, **values):
+    """Creates a queued job (RecalculationJob or BacktestJob) and returns its id, or None if another job of the kind is
+    already active. An active job whose heartbeat is older than <stale_after> seconds (e.g. its worker was killed) is
+    marked failed first"""
+    db.session.execute(update(model)
+                       .where(model.active.is_(True), model.updated_at < utc_now() - dt.timedelta(seconds=stale_after))
+                       .values(status="failed", active=None, error="Abandoned (no progress)", finished_at=utc_now()))
+    job = model(status="queued", active=True, created_at=utc_now(), updated_at=utc_now(), **values)
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:  # Another job is active
+        db.session.rollback()
+        return None
+    return job.id
+
+
+def update_job(db, model, job_id, **values):
+    """Updates a job's record in its own transaction, so progress is visible while the job's own transaction is still
+    open"""
+    with db.engine.begin() as connection:
+        connection.execute(update(model).where(model.id == job_id).values(updated_at=utc_now(), **values))
+
+
+# Recalculation jobs
+def create_recalculation_job(db, from_round, stale_after):
+    """Creates a queued recalculation job and returns its id, or None if another job is already active"""
+    return create_job(db, RecalculationJob, stale_after, from_round=from_round, rounds_done=0)
+
+
+def update_recalculation_job(db, job_id, **values):
+    """Updates a recalculation job's record in its own transaction"""
+    update_job(db, RecalculationJob, job_id, **values)
+
+
+def get_latest_recalculation_job(db):
+    """Returns the most recent recalculation job, or None"""
+    return db.session.execute(db.select(RecalculationJob).order_by(RecalculationJob.id.desc()).limit(1)).scalar()
+
+
+def is_recalculation_active(db, stale_after):
+    """Returns whether a recalculation job is queued or running (ignoring one with no heartbeat for <stale_after> s)"""
+    return db.session.execute(db.select(RecalculationJob.id)
+                              .where(RecalculationJob.active.is_(True),
+                                     RecalculationJob.updated_at >= utc_now() - dt.timedelta(seconds=stale_after))
+                              ).first() is not None
+
+
+# Backtest jobs
+def create_backtest_job(db, grid_size, stale_after):
+    """Creates a queued backtest job and returns its id, or None if another backtest is already active"""
+    return create_job(db, BacktestJob, stale_after, grid_size=grid_size, sets_done=0)
+
+
+def update_backtest_job(db, job_id, **values):
+    """Updates a backtest job's record in its own transaction"""
+    update_job(db, BacktestJob, job_id, **values)
+
+
+def get_latest_backtest_job(db, status=None):
+    """Returns the most recent backtest job (with the given status if any), or None"""
+    query = db.select(BacktestJob).order_by(BacktestJob.id.desc()).limit(1)
+    if status is not None:
+        query = query.where(BacktestJob.status == status)
+    return db.session.execute(query).scalar()
+
+
 def get_player_data(db):
     """Returns player data from the database sorted by rating"""
     result = db.session.execute(db.select(Player).order_by(Player.current_rating.desc()))
@@ -74,209 +347,111 @@ def get_player_data(db):
     return player_data
 
 
-def get_num_games(db, players):
-    """Return the number of games each player has played as a dict {player_name(str):num_games(int)}"""
-    num_games_dict = {}
-    for player in players:
-        num_games_dict[player.name] = db.session.query(GameHistory).filter(GameHistory.player == player).count()
-    return num_games_dict
+def get_latest_lineups(db):
+    """Returns (latest round, line-ups) where the line-ups are a list of (group, [(name, current rating)]), one per
+    game of the latest round, in one query"""
+    latest_round = db.select(func.max(Game.round)).scalar_subquery()
+    rows = db.session.execute(db.select(Game.round, Game.group, Game.bga_id, Player.name, Player.current_rating)
+                              .join(Game.included).join(GameHistory.player)
+                              .where(Game.round == latest_round)
+                              .order_by(Game.group, Game.bga_id, Player.name)).all()
+    lineups = [(group, [(row.name, row.current_rating) for row in entries])
+               for (group, bga_id), entries in groupby(rows, key=lambda row: (row.group, row.bga_id))]
+    return (rows[0].round if rows else None), lineups
 
 
-def get_latest_round(db):
-    """Returns the round number of the latest round"""
-    latest_round = db.session.execute(func.max(Game.round)).scalar()
-    return latest_round
+def get_player_ids(db):
+    """Returns a list of all player IDs"""
+    return db.session.execute(db.select(Player.id).order_by(Player.id)).scalars().all()
 
 
-def get_latest_results(db):
-    """Returns results from the latest round's game results as a dict {group:[results]}"""
-    latest_round = get_latest_round(db)
-    latest_round_games = db.session.execute(db.select(Game).where(Game.round == latest_round)
-                                            .order_by(Game.group)).scalars().all()
-    latest_results = {game.group: game.included for game in latest_round_games}
-    return latest_results
+def get_faction_ids(db):
+    """Returns a list of all faction ids"""
+    return db.session.execute(db.select(Faction.id).order_by(Faction.id)).scalars().all()
 
 
-def get_all_games(db):
-    """Returns a list of all games sorted by round (oldest first) and group"""
-    all_games_data = db.session.execute(db.select(Game).order_by(Game.round, Game.group)).scalars().all()
-    return all_games_data
+def get_game_entries(db, after_round=None):
+    """Returns game_history rows with their round, sorted in play order (round, group, game, score).
+    Only rows from rounds after <after_round> are returned if it is given"""
+    query = (db.select(GameHistory.id, GameHistory.game_id, GameHistory.player_id, GameHistory.faction_id,
+                       GameHistory.bid, GameHistory.score, Game.round)
+             .join(Game)
+             .order_by(Game.round, Game.group, Game.bga_id, GameHistory.score.desc()))
+    if after_round is not None:
+        query = query.where(Game.round > after_round)
+    return db.session.execute(query).all()
 
 
-def split_results(game_data):
-    """Returns a nest dictionary from a list of games with the format {round_num: {group: entries}}"""
-    results_dict = {}
-    for game in game_data:
-        if game.round in results_dict:
-            results_dict[game.round][game.group] = game.included
-        else:
-            results_dict[game.round] = {game.group: game.included}
-    return results_dict
+def bulk_update_ratings(db, player_ratings, entry_ratings):
+    """Writes {player_id: rating} and {entry_id: (old_rating, new_rating)} to the session without committing"""
+    bulk_update_rows(db, Player, [{"id": player_id, "current_rating": rating}
+                                  for player_id, rating in player_ratings.items()])
+    bulk_update_rows(db, GameHistory, [{"id": entry_id, "old_rating": old_rating, "new_rating": new_rating}
+                                       for entry_id, (old_rating, new_rating) in entry_ratings.items()])
 
 
-def get_player(db, player_name):
-    """Returns a player object given a player name"""
-    player = db.session.execute(db.select(Player).where(Player.name == player_name)).scalar()
-    return player
+def bulk_update_faction_ratings(db, faction_ratings):
+    """Writes {faction_id: rating} to the session without committing"""
+    bulk_update_rows(db, Faction, [{"id": faction_id, "current_rating": rating}
+                                   for faction_id, rating in faction_ratings.items()])
 
 
-def get_player_rating(db, player_name):
-    player = get_player(db, player_name)
-    return player.current_rating
+def get_checkpoint_round(db, before_round):
+    """Returns the last round played before <before_round> if it has player and faction rating checkpoints,
+    else None"""
+    last_played_round = db.session.execute(db.select(func.max(Game.round))
+                                           .where(Game.round < before_round)).scalar()
+    checkpoint_round = db.session.execute(db.select(func.max(RatingCheckpoint.round))
+                                          .where(RatingCheckpoint.round < before_round)).scalar()
+    faction_checkpoint_round = db.session.execute(db.select(func.max(FactionCheckpoint.round))
+                                                  .where(FactionCheckpoint.round < before_round)).scalar()
+    if last_played_round is not None and checkpoint_round == faction_checkpoint_round == last_played_round:
+        return checkpoint_round
+    return None
 
 
-def update_player_rating(db, player_name, new_rating):
-    """Updates a player's rating in the players table"""
-    player = get_player(db, player_name)
-    player.current_rating = new_rating
-    db.session.commit()
+def get_rating_checkpoint(db, round_num):
+    """Returns the checkpoint at the end of a round as a dict {player_id: (rating, num_games)}"""
+    checkpoint = db.session.execute(db.select(RatingCheckpoint).where(RatingCheckpoint.round == round_num)).scalars()
+    return {row.player_id: (row.rating, row.num_games) for row in checkpoint}
 
 
-def get_player_games(db, player_name):
-    """Returns a list of game IDs that a player was in, sorted by round (reverse play order)"""
-    player = get_player(db, player_name)
-    query_result = db.session.execute(db.select(GameHistory).join(Game).where(GameHistory.player_id == player.id)
-                    .order_by(Game.round.desc(), GameHistory.score.desc()))
-    player_games = query_result.scalars().all()
-    player_game_ids = [game.game_id for game in player_games]
-    return player_game_ids
+def replace_rating_checkpoints(db, checkpoints, after_round=None):
+    """Replaces all checkpoints after <after_round> (all if None) with a list of checkpoint row dicts, no commit"""
+    query = delete(RatingCheckpoint)
+    if after_round is not None:
+        query = query.where(RatingCheckpoint.round > after_round)
+    db.session.execute(query)
+    bulk_insert_rows(db, RatingCheckpoint, checkpoints)
 
 
-def get_player_game_history(db, player_name):
-    """Returns the game history dict for a player, sorted by round (reverse play order)"""
-    game_history = {}
-    game_ids = get_player_games(db, player_name)
-    for game_id in game_ids:
-        game = db.get_or_404(Game, game_id)
-        game_details = {
-            "round": game.round,
-            "group": game.group,
-            "map": game.map,
-            "num_players": game.num_players,
-            "entries": game.included
-        }
-        game_history[game_id] = game_details
-    return game_history
-
+def get_faction_checkpoint(db, round_num):
+    """Returns the faction checkpoint at the end of a round as a dict {faction_id: (rating, num_games)}"""
+    checkpoint = db.session.execute(db.select(FactionCheckpoint)
+                                    .where(FactionCheckpoint.round == round_num)).scalars()
+    return {row.faction_id: (row.rating, row.num_games) for row in checkpoint}
 
-def get_rating_history(db, player_name):
-    """Returns a list of tuples, (round_num, rating), for named player, sorted by round num"""
-    player = get_player(db, player_name)
-    player_entries = db.session.execute(db.select(GameHistory)
-                                        .where(GameHistory.player_id == player.id)).scalars().all()
-    rating_history = sorted([(entry.game.round, entry.new_rating) for entry in player_entries])
-    rating_history = [(rating_history[0][0]-1, 1000)] + rating_history
-    return rating_history
 
-
-def get_high_rating(db, player_name, threshold):
-    """Returns highest rating with at least <threshold> games, else '--' if below <threshold> total games"""
-    rating_history = get_rating_history(db, player_name)
-    if len(rating_history)-1 < threshold:  # -1 because the first is the starting rating at game 0
-        return "--"
-    else:
-        high_rating = max([rating for round_num, rating in rating_history[threshold:]])
-        return high_rating
-
-
-def get_player_records(db, player_name):
-    player = get_player(db, player_name)
-    player_records = (db.session.execute(db.select(GameHistory).where(GameHistory.player_id == player.id))
-                      .scalars().all())
-    return player_records
-
-
-def get_most_played_faction(db, player_name):
-    """Returns a dict with the most played faction and number of times played (multiple if tied)"""
-    faction_tally = {}
-    player_records = get_player_records(db, player_name)
-    for record in player_records:
-        faction = record.faction.name.replace(" ", "")
-        if faction in faction_tally:
-            faction_tally[faction] += 1
-        else:
-            faction_tally[faction] = 1
-    max_value = max(faction_tally.values())
-    max_factions = {faction:faction_tally[faction] for faction in faction_tally if faction_tally[faction] == max_value}
-    return max_factions
-
-
-def get_results_highlights(db, player_name, game_history):
-    """Returns a dict with player's 1st, 2nd, 3rd placements and total games by group"""
-    groups = db.session.execute(db.select(Game.group).distinct()).scalars().all()
-    result_highlights = {group: {1: 0, 2: 0, 3: 0, "Total": 0} for group in groups}
-    # Loop through games in their history
-    for game_id in list(game_history.keys()):
-        entries = game_history[game_id]["entries"]
-        for entry in entries:
-            if entry.player.name == player_name:
-                # Check if the player was 1st, 2nd, or 3rd
-                if entries.index(entry) < 3:
-                    # Iterate the appropriate total based on the index of the entry and round
-                    result_highlights[entry.game.group][entries.index(entry)+1] += 1
-                # Iterate the round total regardless of placement
-                result_highlights[entry.game.group]["Total"] += 1
-    return result_highlights
-
-
-def get_faction_color(db, faction_name):
-    faction = db.session.execute(db.select(Faction).where(Faction.name == faction_name)).scalar()
-    return faction.color
-
-
-def get_faction_bg_color(db, most_played_dict):
-    if len(list(most_played_dict.keys())) == 1:
-        faction = list(most_played_dict.keys())[0]
-        # TODO: Rework this so the following adjustment isn't necessary
-        if faction in ["ChaosMagicians", "IceMaidens"]:
-            faction = faction.replace("M", " M")
-        return get_faction_color(db, faction)
-    else:
-        return "220, 226, 230"
-
-
-def get_score_stats(db, player_name, game_history):
-    player = get_player(db, player_name)
-    player_scores = []
-    player_bids = []
-    game_avg_scores = []
-    for game_id in list(game_history.keys()):
-        entries = game_history[game_id]["entries"]
-        game_avg_scores.append(mean([entry.score for entry in entries]))
-        for entry in entries:
-            if entry.player_id == player.id:
-                player_scores.append(entry.score)
-                player_bids.append(entry.bid)
-    score_stats = {
-        "avg_final_score": round(mean(player_scores), 1),
-        "avg_starting_score": round(mean(player_bids), 1),
-        "avg_net_gained": round(mean([score - bid for score, bid in zip(player_scores, player_bids)]), 1),
-        "relative_to_game_avg": round(mean([score - avg for score, avg in zip(player_scores, game_avg_scores)]), 1)
-    }
-    return score_stats
-
-
-def get_head_to_head(db, player_name):
-    """Returns a dict with results vs each other player as a tuple, (W, L, D)"""
-    head_to_head = {}
-    this_player = get_player(db, player_name)
-    for player in get_player_data(db):
-        if player != this_player:
-            head_to_head[player.name] = [0, 0, 0]
-    for game_id in get_player_games(db, player_name):
-        game = db.session.execute(db.select(Game).where(Game.bga_id == game_id)).scalar()
-        player_score = [entry.score for entry in game.included if entry.player_id == this_player.id][0]
-        other_players = [entry for entry in game.included if entry.player_id != this_player.id]
-        for player_entry in other_players:
-            if player_score > player_entry.score:
-                head_to_head[player_entry.player.name][0] += 1
-            elif player_score < player_entry.score:
-                head_to_head[player_entry.player.name][1] += 1
-            else:
-                head_to_head[player_entry.player.name][2] += 1
-    return head_to_head
+def replace_faction_checkpoints(db, checkpoints, after_round=None):
+    """Replaces all faction checkpoints after <after_round> (all if None) with a list of row dicts, no commit"""
+    query = delete(FactionCheckpoint)
+    if after_round is not None:
+        query = query.where(FactionCheckpoint.round > after_round)
+    db.session.execute(query)
+    bulk_insert_rows(db, FactionCheckpoint, checkpoints)
 
 
+def get_history_rows(db):
+    """Returns (game_id, player_id, faction_id, round, group, map, num_players, bid, score, new_rating) for every
+    game_history row, sorted by game and score (best first), for building GameColumns"""
+    return db.session.execute(db.select(GameHistory.game_id, GameHistory.player_id, GameHistory.faction_id,
+                                        Game.round, Game.group, Game.map, Game.num_players, GameHistory.bid,
+                                        GameHistory.score, GameHistory.new_rating)
+                              .join(Game).order_by(GameHistory.game_id, GameHistory.score.desc(),
+                                                   GameHistory.id)).all()
+
+
+# Profile page
 def get_col_spans(game_history):
     """Returns a dict of {game_id:col_spans} for the player game history table taking into account ties"""
     col_spans_dict = {}
@@ -290,3 +465,101 @@ def get_col_spans(game_history):
                     col_spans[i] = 0
         col_spans_dict[game_id] = col_spans
     return col_spans_dict
+
+
+def average(total, count):
+    """Returns total / count, as an int if it divides exactly (like statistics.mean of ints)"""
+    if isinstance(total, int) and total % count == 0:
+        return total // count
+    return total / count
+
+
+def build_profile_data(player, games, groups):
+    """Returns (profile_data, game_history) computed in memory from a player (with their stats linked), their games
+    (reverse play order, each with its entries sorted by score) and all groups"""
+    game_history = {}
+    for game in games:
+        game_history[game.bga_id] = {
+            "round": game.round,
+            "group": game.group,
+            "map": game.map,
+            "num_players": game.num_players,
+            "entries": game.included
+        }
+
+    # 1st, 2nd, 3rd placements and total games by group, zero for the league's groups (EMOJIS) nobody has played yet
+    results_highlights = {group: {1: 0, 2: 0, 3: 0, "Total": 0} for group in dict.fromkeys([*EMOJIS, *groups])}
+    for row in player.group_stats:
+        results_highlights[row.group] = {1: row.first, 2: row.second, 3: row.third, "Total": row.total}
+
+    # Most played faction(s), none for a player without games
+    max_value = max((row.num_games for row in player.faction_stats), default=0)
+    most_played = sorted([row.faction for row in player.faction_stats if row.num_games == max_value],
+                         key=lambda faction: faction.name)
+    most_played_faction = {faction.name.replace(" ", ""): max_value for faction in most_played}
+    if len(most_played) == 1:
+        faction_bg_color = most_played[0].color
+    else:
+        faction_bg_color = "220, 226, 230"
+
+    # Score stats ("--" without games)
+    stats = player.stats
+    if stats.num_games:
+        score_stats = {
+            "avg_final_score": round(average(stats.score_sum, stats.num_games), 1),
+            "avg_starting_score": round(average(stats.bid_sum, stats.num_games), 1),
+            "avg_net_gained": round(average(stats.score_sum - stats.bid_sum, stats.num_games), 1),
+            "relative_to_game_avg": round(average(stats.relative_score_sum, stats.num_games), 1)
+        }
+    else:
+        score_stats = dict.fromkeys(["avg_final_score", "avg_starting_score", "avg_net_gained",
+                                     "relative_to_game_avg"], "--")
+
+    profile_data = {
+        "player_name": player.name,
+        "current_rating": player.current_rating,
+        "num_games": stats.num_games,
+        "high_rating": "--" if stats.high_rating is None else stats.high_rating,
+        "results_highlights": results_highlights,
+        "most_played_faction": most_played_faction,
+        "faction_bg_color": faction_bg_color,
+        "score_stats": score_stats
+    }
+    return profile_data, game_history
+
+
+# League snapshot
+def get_snapshot_rows(db):
+    """Returns (league version, {table: rows}) with every table the public pages read, one plain (column tuple) query
+    per table, for building a LeagueSnapshot (see snapshot.py), which derives the player stats from the entries.
+    Entries are sorted by game and score (best first). Rating checkpoints are only those of players who had played by
+    then (the standings rows).
+    Everything is read in one transaction on its own connection (REPEATABLE READ on Postgres), so the tables and the
+    version all come from the same commit"""
+    queries = {
+        "players": db.select(Player.id, Player.name, Player.current_rating).order_by(Player.id),
+        "factions": db.select(Faction.id, Faction.name, Faction.color, Faction.current_rating).order_by(Faction.id),
+        "games": db.select(Game.bga_id, Game.round, Game.group, Game.map, Game.num_players)
+                   .order_by(Game.round, Game.group, Game.bga_id),
+        "entries": db.select(GameHistory.id, GameHistory.game_id, GameHistory.player_id, GameHistory.faction_id,
+                             GameHistory.bid, GameHistory.score, GameHistory.old_rating, GameHistory.new_rating)
+                     .order_by(GameHistory.game_id, GameHistory.score.desc(), GameHistory.id),
+        "rating_checkpoints": db.select(RatingCheckpoint.round, RatingCheckpoint.player_id, RatingCheckpoint.rating,
+                                        RatingCheckpoint.num_games, RatingCheckpoint.rank,
+                                        RatingCheckpoint.rating_change)
+                                .where(RatingCheckpoint.num_games > 0)
+                                .order_by(RatingCheckpoint.round, RatingCheckpoint.player_id),
+        "faction_checkpoints": db.select(FactionCheckpoint.faction_id, FactionCheckpoint.round,
+                                         FactionCheckpoint.rating)
+                                 .order_by(FactionCheckpoint.faction_id, FactionCheckpoint.round),
+        "results_revisions": db.select(ResultsRevision.version, ResultsRevision.after_round),
+    }
+    with db.engine.connect() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execution_options(isolation_level="REPEATABLE READ")
+        with connection.begin():
+            if connection.dialect.name == "sqlite":
+                # pysqlite only opens a transaction before a write, so without this each SELECT reads its own commit
+                connection.exec_driver_sql("BEGIN")
+            version = connection.execute(db.select(LeagueVersion.version).where(LeagueVersion.id == 1)).scalar_one()
+            return version, {table: connection.execute(query).all() for table, query in queries.items()}
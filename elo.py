@@ -1,60 +1,207 @@
+from itertools import groupby
+
 import numpy as np
 
-from constants import C, MIN_K, MAX_K, STARTING_RATING
-from database_manager import get_player_data, update_player_rating, get_all_games, get_player_rating
+from constants import C, MIN_K, MAX_K, K_NUMERATOR, STARTING_RATING
+from database_manager import (get_player_ids, get_faction_ids, get_game_entries, bulk_update_ratings,
+                              bulk_update_faction_ratings, get_checkpoint_round, get_rating_checkpoint,
+                              get_faction_checkpoint, replace_rating_checkpoints, replace_faction_checkpoints,
+                              bump_league_version, record_results_revision)
 
 
-def calculate_winloss_matrix(game_results):
-    """Returns a win-loss matrix from a set of game results"""
-    scores = np.array([entry.score for entry in game_results])
-    score_delta_matrix = np.zeros((len(scores), len(scores)))
-    for i, score in enumerate(scores):
-        score_delta_matrix[i] = score - scores
+def winloss_matrix(scores):
+    """Returns win-loss matrices from a (..., players) array of game scores"""
+    score_delta_matrix = scores[..., :, np.newaxis] - scores[..., np.newaxis, :]
     winloss_matrix = (np.sign(score_delta_matrix) + 1) / 2
     return winloss_matrix
 
 
+def expected_matrix(ratings, c=C):
+    """Returns expected win probability matrices from a (..., players) array of pre-game ratings"""
+    q_list = 10 ** (ratings / c)
+    expected_matrix = q_list[..., :, np.newaxis] / (q_list[..., :, np.newaxis] + q_list[..., np.newaxis, :])
+    return expected_matrix
+
+
+def calculate_winloss_matrix(game_results):
+    """Returns a win-loss matrix from a set of game results"""
+    return winloss_matrix(np.array([entry.score for entry in game_results]))
+
+
 def calculate_expected_matrix(game_results):
     """Returns the expected win probability matrix from a set of game results"""
-    ratings = np.array([entry.old_rating for entry in game_results])
-    expected_matrix = np.zeros((len(ratings), len(ratings)))
-    q_list = 10 ** (ratings / C)
-    for i, q in enumerate(q_list):
-        expected_matrix[i] = q / (q + q_list)
-    return expected_matrix
+    return expected_matrix(np.array([entry.old_rating for entry in game_results]))
+
+
+def calculate_batch_ratings(scores, old_ratings, num_games, mask, k_scale=1, c=C, min_k=MIN_K, max_k=MAX_K,
+                            k_numerator=K_NUMERATOR):
+    """Returns new ratings for a batch of games from padded (games x max_players) arrays of scores, old ratings and
+    games played before each game. <mask> is True for real entries; padded entries keep their old rating.
+    The rating constants can be overridden, including with arrays that broadcast against the ratings (e.g. a
+    (parameter sets x 1 x 1) array with (parameter sets x games x max_players) ratings, see backtest.py)"""
+    expected = expected_matrix(old_ratings, c)
+    actual = winloss_matrix(scores)
+    k = np.minimum(np.maximum((k_numerator / (num_games + 1)), min_k), max_k)[..., np.newaxis]
+
+    pair_mask = mask[..., :, np.newaxis] & mask[..., np.newaxis, :]
+    rating_change_matrix = np.where(pair_mask, (k * k_scale) * (actual - expected), 0)
+    player_rating_changes = rating_change_matrix.sum(axis=-1)
+    return np.where(mask, old_ratings + np.trunc(player_rating_changes).astype(int), old_ratings)
+
+
+def calculate_new_ratings(scores, old_ratings, num_games, k_scale=1):
+    """Returns an array of new ratings for one game given arrays of scores, old ratings and games played before it"""
+    mask = np.ones((1, len(scores)), dtype=bool)
+    return calculate_batch_ratings(scores[np.newaxis], old_ratings[np.newaxis], num_games[np.newaxis], mask,
+                                   k_scale)[0]
+
+
+def pad_games(values, fill=0):
+    """Returns a padded (games x max_players) array from a list of per-game lists and the mask of real entries"""
+    game_sizes = np.array([len(game) for game in values])
+    mask = np.arange(game_sizes.max()) < game_sizes[:, np.newaxis]
+    padded = np.full(mask.shape, fill)
+    padded[mask] = np.concatenate(values)
+    return padded, mask
+
+
+def split_disjoint(games, key):
+    """Splits a list of games (lists of entries) into batches in which no key (e.g. player) appears twice.
+    A game always lands in a later batch than any earlier game sharing one of its keys, so play order is kept"""
+    batches = []
+    last_batch = {}
+    for game in games:
+        keys = [key(entry) for entry in game]
+        batch_num = max((last_batch[k] + 1 for k in keys if k in last_batch), default=0)
+        if batch_num == len(batches):
+            batches.append([])
+        batches[batch_num].append(game)
+        last_batch.update({k: batch_num for k in keys})
+    return batches
 
 
 def calculate_new_elos(game_results, num_games, k_scale=1):
     """Returns game results with new ratings updated"""
-    expected = calculate_expected_matrix(game_results)
-    actual = calculate_winloss_matrix(game_results)
-    num_games_array = np.array([num_games[entry.player.name]+1 for entry in game_results])
-    k = np.minimum(np.maximum((800 / num_games_array[:, np.newaxis]), MIN_K), MAX_K)
-
-    rating_change_matrix = (k * k_scale) * (actual - expected)
-    player_rating_changes = rating_change_matrix.sum(axis=1)
-    for i, entry in enumerate(game_results):
-        entry.new_rating = int(entry.old_rating + int(player_rating_changes[i]))
+    new_ratings = calculate_new_ratings(np.array([entry.score for entry in game_results]),
+                                        np.array([entry.old_rating for entry in game_results]),
+                                        np.array([num_games[entry.player.name] for entry in game_results]),
+                                        k_scale)
+    for entry, new_rating in zip(game_results, new_ratings):
+        entry.new_rating = int(new_rating)
     return game_results
 
 
-def recalculate_elos(db):
-    all_players = get_player_data(db)
+def rate_batch(batch, index, ratings, num_games, key, score):
+    """Rates a batch of games (lists of entries) in which no key appears twice, updating the in-memory <ratings> and
+    <num_games> arrays of whatever <key> picks out (players or factions) in place.
+    Returns the indices, old ratings and new ratings of the batch's entries, in order"""
+    rated, mask = pad_games([[index[key(entry)] for entry in game] for game in batch])
+    scores, _ = pad_games([[score(entry) for entry in game] for game in batch])
+    old_ratings = ratings[rated]
+    new_ratings = calculate_batch_ratings(scores, old_ratings, num_games[rated], mask)
+    ratings[rated[mask]] = new_ratings[mask]
+    num_games[rated[mask]] += 1
+    return rated[mask], old_ratings[mask], new_ratings[mask]
+
+
+def faction_score(entry):
+    """Returns an entry's bid-adjusted score. The bid is the VP the player starts with (see the profile's net gained),
+    so the points gained on top of it measure how well the faction itself did"""
+    return entry.score - entry.bid
+
+
+def replay_games(game_entries, player_ids, faction_ids, checkpoint=None, faction_checkpoint=None, progress=None):
+    """Replays game entries (sorted in play order) using in-memory arrays, rating players and (by bid-adjusted score)
+    factions in the same pass. Starts from checkpoints {player_id: (rating, num_games)} and
+    {faction_id: (rating, num_games)}, or from the starting rating if None. <progress>, if given, is called with
+    (rounds_done, rounds_total) after each round.
+    Returns ({player_id: rating}, {entry_id: (old_rating, new_rating)}, [checkpoint rows at the end of each round],
+    {faction_id: rating}, [faction checkpoint rows at the end of each round])"""
+    index = {player_id: i for i, player_id in enumerate(player_ids)}
+    ratings = np.full(len(player_ids), STARTING_RATING, dtype=int)
+    num_games = np.zeros(len(player_ids), dtype=int)
+    for player_id, (rating, games) in (checkpoint or {}).items():
+        ratings[index[player_id]] = rating
+        num_games[index[player_id]] = games
+
+    faction_index = {faction_id: i for i, faction_id in enumerate(faction_ids)}
+    faction_ratings = np.full(len(faction_ids), STARTING_RATING, dtype=int)
+    faction_num_games = np.zeros(len(faction_ids), dtype=int)
+    for faction_id, (rating, games) in (faction_checkpoint or {}).items():
+        faction_ratings[faction_index[faction_id]] = rating
+        faction_num_games[faction_index[faction_id]] = games
+
+    entry_ratings = {}
+    checkpoints = []
+    faction_checkpoints = []
+
+    rounds_total = len({entry.round for entry in game_entries})
+    for rounds_done, (round_num, round_entries) in enumerate(groupby(game_entries, key=lambda entry: entry.round), 1):
+        games = [list(entries) for game_id, entries in groupby(round_entries, key=lambda entry: entry.game_id)]
+        round_start_ratings = ratings.copy()
+
+        # Games in a round normally have disjoint players, so the whole round is rated in one call
+        for batch in split_disjoint(games, key=lambda entry: entry.player_id):
+            entries = [entry for game in batch for entry in game]
+            players, old_ratings, new_ratings = rate_batch(batch, index, ratings, num_games,
+                                                           key=lambda entry: entry.player_id,
+                                                           score=lambda entry: entry.score)
+            for entry, old_rating, new_rating in zip(entries, old_ratings, new_ratings):
+                entry_ratings[entry.id] = (int(old_rating), int(new_rating))
+
+        # Factions are shared between groups, so a round usually takes a few batches
+        for batch in split_disjoint(games, key=lambda entry: entry.faction_id):
+            rate_batch(batch, faction_index, faction_ratings, faction_num_games,
+                       key=lambda entry: entry.faction_id, score=faction_score)
+
+        # Snapshot every player (with their rank) and faction at the end of the round
+        ranks = standings_ranks(ratings, num_games)
+        checkpoints += [{"round": round_num, "player_id": player_id, "rating": int(ratings[i]),
+                         "num_games": int(num_games[i]), "rank": int(ranks[i]) if num_games[i] else None,
+                         "rating_change": int(ratings[i] - round_start_ratings[i])}
+                        for player_id, i in index.items()]
+        faction_checkpoints += [{"round": round_num, "faction_id": faction_id, "rating": int(faction_ratings[i]),
+                                 "num_games": int(faction_num_games[i])} for faction_id, i in faction_index.items()]
+        if progress is not None:
+            progress(rounds_done, rounds_total)
+
+    player_ratings = {player_id: int(ratings[i]) for player_id, i in index.items()}
+    faction_ratings = {faction_id: int(faction_ratings[i]) for faction_id, i in faction_index.items()}
+    return player_ratings, entry_ratings, checkpoints, faction_ratings, faction_checkpoints
+
+
+def standings_ranks(ratings, num_games):
+    """Returns each player's rank by rating among players who have played (1 + number rated higher, so ties share a
+    rank). Ranks of players who haven't played are meaningless"""
+    played_ratings = np.sort(ratings[num_games > 0])
+    return 1 + len(played_ratings) - np.searchsorted(played_ratings, ratings, side="right")
+
+
+class LeagueDataChanged(Exception):
+    """Raised when the league data changed while a recalculation was running, so its results are stale"""
+
 
-    # Return all player ratings to the starting rating and create a num_games dict to iterate
-    num_games = {player.name: 0 for player in all_players}
-    for player in all_players:
-        update_player_rating(db, player.name, STARTING_RATING)
+def recalculate_elos(db, from_round=None, progress=None, expected_version=None):
+    """Recalculates player and faction ratings in one transaction.
+    If <from_round> is given, only games from that round onwards are replayed, starting from the checkpoint of the
+    round before (falls back to a full replay if that checkpoint doesn't exist). <progress> is passed to replay_games.
+    If <expected_version> is given and the league version has moved on from it by the time the results are written,
+    nothing is written and LeagueDataChanged is raised"""
+    start_round = get_checkpoint_round(db, from_round) if from_round is not None else None
+    checkpoint = get_rating_checkpoint(db, start_round) if start_round is not None else None
+    faction_checkpoint = get_faction_checkpoint(db, start_round) if start_round is not None else None
 
-    # Loop through games and calculate new ratings
-    for game in get_all_games(db):
-        game_results = game.included
-        for entry in game_results:
-            entry.old_rating = get_player_rating(db, entry.player.name)
-        game_results = calculate_new_elos(game_results, num_games)
+    player_ratings, entry_ratings, checkpoints, faction_ratings, faction_checkpoints = replay_games(
+        get_game_entries(db, after_round=start_round), get_player_ids(db), get_faction_ids(db), checkpoint,
+        faction_checkpoint, progress)
 
-        # Update database and iterate num_games dict
-        for entry in game_results:
-            update_player_rating(db, player_name=entry.player.name, new_rating=entry.new_rating)
-            db.session.commit()
-            num_games[entry.player.name] += 1
+    # The version row is written first, so it also locks out other writers (on Postgres) until the commit
+    if not bump_league_version(db, expected_version):
+        db.session.rollback()
+        raise LeagueDataChanged()
+    record_results_revision(db, start_round)
+    bulk_update_ratings(db, player_ratings, entry_ratings)
+    bulk_update_faction_ratings(db, faction_ratings)
+    replace_rating_checkpoints(db, checkpoints, after_round=start_round)
+    replace_faction_checkpoints(db, faction_checkpoints, after_round=start_round)
+    db.session.commit()
@@ -0,0 +1,135 @@
+"""Runs EXPLAIN on every query production issues outside the snapshot load (the per-request version check, the
+add game and import lookups, and the per-round reads of an incremental replay) against a seeded database and fails
+if any of them scans a hot table sequentially, e.g.
+python explain_check.py --db sqlite:///bench.db --generate --reset
+Public pages read the in-process league snapshot (snapshot.py), whose load and the full replay read whole tables, so
+those aren't checked. On Postgres, sequential scans are disabled for the check, so one only shows up when no index can
+serve the query"""
+import argparse
+import json
+import os
+import sys
+
+from sqlalchemy import event, func
+
+HOT_TABLES = {"game", "game_history", "rating_checkpoint", "faction_checkpoint"}
+
+
+def hot_path_helpers(db):
+    """Returns {name: function} for the production code paths whose queries should all be index lookups"""
+    import database_manager as dm
+    from constants import RECALCULATION_STALE_AFTER
+    from importer import import_games
+
+    latest_round = db.session.execute(db.select(func.max(dm.Game.round))).scalar()
+    game = db.session.execute(db.select(dm.Game).where(dm.Game.round == latest_round)).scalars().first()
+    # Re-adding an existing game runs the import's lookups, then fails validation before anything is written
+    duplicate_game = {"bga_id": game.bga_id, "round": game.round, "group": game.group, "map": game.map,
+                      "entries": [{"player": entry.player.name, "faction": entry.faction.name, "bid": entry.bid,
+                                   "score": entry.score} for entry in game.included]}
+    return {
+        "get_league_version": lambda: dm.get_league_version(db),
+        "is_recalculation_active": lambda: dm.is_recalculation_active(db, RECALCULATION_STALE_AFTER),
+        "get_latest_recalculation_job": lambda: dm.get_latest_recalculation_job(db),
+        "get_latest_backtest_job": lambda: dm.get_latest_backtest_job(db, status="succeeded"),
+        "import_games (validation)": lambda: import_games(db, [duplicate_game]),
+        "get_checkpoint_round": lambda: dm.get_checkpoint_round(db, latest_round),
+        "get_rating_checkpoint": lambda: dm.get_rating_checkpoint(db, latest_round - 1),
+        "get_faction_checkpoint": lambda: dm.get_faction_checkpoint(db, latest_round - 1),
+        "get_game_entries (latest round)": lambda: dm.get_game_entries(db, after_round=latest_round - 1),
+        "get_latest_lineups": lambda: dm.get_latest_lineups(db),
+    }
+
+
+def capture_statements(engine, func):
+    """Returns the distinct SELECT statements (with parameters) that <func> runs"""
+    statements = {}
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and not executemany:
+            statements.setdefault(statement, parameters)
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        func()
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+    return statements
+
+
+def sequential_scans(connection, statement, parameters):
+    """Returns (the plan as text, the hot tables it scans sequentially)"""
+    if connection.dialect.name == "postgresql":
+        plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters).scalar()
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        nodes, scans = [plan[0]["Plan"]], []
+        while nodes:
+            node = nodes.pop()
+            if node["Node Type"] == "Seq Scan" and node.get("Relation Name") in HOT_TABLES:
+                scans.append(node["Relation Name"])
+            nodes += node.get("Plans", [])
+        return json.dumps(plan, indent=1), scans
+
+    # SQLite: "SCAN <table>" (with or without an index) reads the whole table, "SEARCH" is an index lookup
+    rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    scans = []
+    for row in rows:
+        words = row[-1].split()
+        if words[0] == "SCAN" and words[1] in HOT_TABLES:
+            scans.append(words[1])
+    return "\n".join(row[-1] for row in rows), scans
+
+
+def run_check(db, verbose=False):
+    """Explains every hot-path query and returns the list of failures (helper, tables, statement, plan)"""
+    failures = []
+    for name, helper in hot_path_helpers(db).items():
+        statements = capture_statements(db.engine, helper)
+        db.session.rollback()
+        with db.engine.connect() as connection:
+            if connection.dialect.name == "postgresql":
+                connection.exec_driver_sql("SET enable_seqscan = off")
+            for statement, parameters in statements.items():
+                plan, scans = sequential_scans(connection, statement, parameters)
+                if scans:
+                    failures.append((name, scans, statement, plan))
+                if verbose:
+                    print(f"--- {name}\n{statement}\n{plan}\n")
+            connection.rollback()
+        print(f"{'FAIL' if any(failure[0] == name for failure in failures) else 'ok':<5} {name} "
+              f"({len(statements)} queries)")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fail if a hot-path query scans a hot table sequentially")
+    parser.add_argument("--db", default=os.environ.get("DB_URI", "sqlite:///bench.db"),
+                        help="database URI (SQLite or Postgres), default $DB_URI or sqlite:///bench.db")
+    parser.add_argument("--generate", action="store_true", help="replace the league data with a synthetic league")
+    parser.add_argument("--reset", action="store_true", help="required with --generate, which replaces all league data")
+    parser.add_argument("--verbose", action="store_true", help="print every query plan")
+    args = parser.parse_args()
+    if args.generate and not args.reset:
+        parser.error(f"--generate replaces all league data in {args.db}, pass --reset to confirm")
+
+    # The app reads its database from the environment when it is imported (which also runs the migrations)
+    os.environ["DB_URI"] = args.db
+    from main import app
+    from database_manager import db
+    from synthetic_league import generate_league
+
+    with app.app_context():
+        if args.generate:
+            generate_league(db)
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("ANALYZE")
+        failures = run_check(db, args.verbose)
+
+    for name, scans, statement, plan in failures:
+        print(f"\n{name} scans {', '.join(sorted(set(scans)))}:\n{statement}\n{plan}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Faction results (games, win rate, average score, bid and place) by map, group and player count. The history is
+aggregated once per league version, in one vectorized pass over the columnar history, into a cell per (round,
+faction, map, group, player count). The cells are sorted by round, so a filtered view only sums the cells of the
+matching rounds"""
+import numpy as np
+
+from constants import MAPS
+
+METRICS = ["games", "win_rate", "avg_score", "avg_bid", "avg_place"]
+BREAKDOWNS = {"map": "Map", "group": "Group", "players": "Players"}
+
+
+def shared_places(columns):
+    """Returns each entry's place in its game with tied scores sharing a place (1 + number of better scores)"""
+    index = np.arange(len(columns))
+    game_starts = np.searchsorted(columns.game, columns.game)
+    new_score = np.ones(len(columns), dtype=bool)
+    new_score[1:] = (columns.score[1:] != columns.score[:-1]) | (columns.game[1:] != columns.game[:-1])
+    score_starts = np.maximum.accumulate(np.where(new_score, index, 0))
+    return score_starts - game_starts + 1
+
+
+class FactionAnalytics:
+    """Per-round pre-aggregated faction results, built from GameColumns and the faction names (in faction id order)"""
+    __slots__ = ("factions", "maps", "groups", "player_counts", "round", "faction", "map", "group", "players",
+                 "totals")
+
+    def __init__(self, columns, faction_names):
+        self.factions = list(faction_names)
+        # Maps in the order of the add game form, any others after
+        map_order = {name: i for i, (name, label) in enumerate(MAPS)}
+        self.maps = sorted(columns.maps.tolist(), key=lambda name: (map_order.get(name, len(map_order)), name))
+        self.groups = columns.groups.tolist()
+        self.player_counts, players = np.unique(columns.num_players, return_inverse=True)
+        self.player_counts = self.player_counts.tolist()
+        map_index = np.array([self.maps.index(name) for name in columns.maps.tolist()], dtype=np.int64)
+        rounds, round_index = np.unique(columns.round, return_inverse=True)
+
+        # One key per cell, round first so the cells come out sorted by round
+        shape = (len(rounds), len(self.factions), len(self.maps), len(self.groups), len(self.player_counts))
+        keys = np.ravel_multi_index((round_index, columns.faction, map_index[columns.map], columns.group, players),
+                                    shape) if len(columns) else np.zeros(0, dtype=np.int64)
+        cells, cell = np.unique(keys, return_inverse=True)
+        cell_round, self.faction, self.map, self.group, self.players = np.unravel_index(cells, shape)
+        self.round = rounds[cell_round] if len(rounds) else cell_round
+
+        # Sums per cell: [games, wins, score, bid, place]
+        places = shared_places(columns)
+        self.totals = np.stack([np.bincount(cell, weights=weights, minlength=len(cells)) for weights in
+                                [None, places == 1, columns.score, columns.bid, places]], axis=1)
+
+    def round_range(self):
+        """Returns (first round, latest round), both None if there are no games"""
+        return (int(self.round[0]), int(self.round[-1])) if len(self.round) else (None, None)
+
+    def query(self, map_name=None, group=None, first_round=None, last_round=None):
+        """Returns the stats of the games matching the filters as {"overall": rows, "map": ..., "group": ...,
+        "players": ...}. Overall rows are (faction, stats) for factions with games, by win rate; each breakdown is
+        (values, [(faction, [stats per value])]) in the overall order. Stats are dicts of METRICS (None without
+        games)"""
+        start = 0 if first_round is None else np.searchsorted(self.round, first_round, side="left")
+        stop = len(self.round) if last_round is None else np.searchsorted(self.round, last_round, side="right")
+        selected = np.arange(start, stop)
+        if map_name is not None:
+            selected = selected[self.map[selected] == (self.maps.index(map_name) if map_name in self.maps else -1)]
+        if group is not None:
+            selected = selected[self.group[selected] == (self.groups.index(group) if group in self.groups else -1)]
+
+        totals = self.totals[selected]
+        faction = self.faction[selected]
+        overall = sum_by(faction, totals, len(self.factions))
+        order = sorted(np.flatnonzero(overall[:, 0]), key=lambda i: (-overall[i, 1] / overall[i, 0],
+                                                                    self.factions[i]))
+        results = {"overall": [(self.factions[i], summarise(overall[i])) for i in order]}
+        for breakdown, column, values in [("map", self.map, self.maps), ("group", self.group, self.groups),
+                                          ("players", self.players, self.player_counts)]:
+            sums = sum_by(faction * len(values) + column[selected], totals, len(self.factions) * len(values))
+            sums = sums.reshape(len(self.factions), len(values), self.totals.shape[1])
+            results[breakdown] = (values, [(self.factions[i], [summarise(cell) for cell in sums[i]]) for i in order])
+        return results
+
+
+def sum_by(index, totals, length):
+    """Returns the rows of <totals> summed by <index> (0 to <length> - 1)"""
+    return np.stack([np.bincount(index, weights=totals[:, i], minlength=length) for i in range(totals.shape[1])],
+                    axis=1)
+
+
+def summarise(sums):
+    """Returns the METRICS from a row of [games, wins, score, bid, place] sums"""
+    games = int(sums[0])
+    if not games:
+        return dict.fromkeys(METRICS)
+    return {"games": games, **{metric: float(total / games)
+                               for metric, total in zip(["win_rate", "avg_score", "avg_bid", "avg_place"], sums[1:])}}
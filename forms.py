@@ -1,8 +1,11 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms import StringField, IntegerField, SelectField, SubmitField, PasswordField
-from wtforms.validators import DataRequired, Optional, NumberRange
+from wtforms.validators import DataRequired, Optional, NumberRange, Regexp
 
-from constants import MAPS, FACTIONS
+from constants import MAPS, FACTIONS, BACKTEST_GRID
+
+NUMBER_LIST = Regexp(r"^\s*\d+(\.\d+)?(\s*,\s*\d+(\.\d+)?)*\s*$", message="Enter comma-separated numbers")
 
 
 class AddPlayerForm(FlaskForm):
@@ -45,6 +48,23 @@ class AddGameForm(FlaskForm):
     submit = SubmitField("Add Game")
 
 
+class ImportGamesForm(FlaskForm):
+    games_file = FileField("Games file (.csv or .json)", validators=[FileRequired(), FileAllowed(["csv", "json"])])
+    submit = SubmitField("Import Games")
+
+
+class BacktestForm(FlaskForm):
+    c = StringField("C", default=", ".join(map(str, BACKTEST_GRID["c"])), validators=[DataRequired(), NUMBER_LIST])
+    min_k = StringField("MIN_K", default=", ".join(map(str, BACKTEST_GRID["min_k"])),
+                        validators=[DataRequired(), NUMBER_LIST])
+    max_k = StringField("MAX_K", default=", ".join(map(str, BACKTEST_GRID["max_k"])),
+                        validators=[DataRequired(), NUMBER_LIST])
+    k_numerator = StringField("K numerator (K = numerator / (games played + 1))",
+                              default=", ".join(map(str, BACKTEST_GRID["k_numerator"])),
+                              validators=[DataRequired(), NUMBER_LIST])
+    submit = SubmitField("Run Backtest")
+
+
 class RegisterForm(FlaskForm):
     username = StringField("Username", validators=[DataRequired()], render_kw={"placeholder": "Username"})
     password = PasswordField("Password", validators=[DataRequired()], render_kw={"placeholder": "Password"})
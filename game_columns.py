@@ -0,0 +1,86 @@
+"""Columnar copy of the game history: one NumPy array per column of game_history (with each entry's game, round,
+group, map and player count, and its place in the game), so stats for every player are computed at once with
+group-by operations (bincount, ufunc.at and sorted segments) rather than Python loops over one player's entries"""
+import numpy as np
+
+from constants import HIGH_RATING_THRESHOLD
+
+PLACES = 3  # Placements counted per group (1st, 2nd, 3rd)
+
+
+class GameColumns:
+    """The game history as parallel arrays, one element per entry. <player>, <faction>, <game>, <group> and <map>
+    are indices into <player_ids>, <faction_ids>, <game_ids>, <groups> and <maps>; <rank> is the entry's place in
+    its game (1 = best score, ties in entry order)"""
+    __slots__ = ("player_ids", "faction_ids", "game_ids", "groups", "maps", "player", "faction", "game", "round",
+                 "group", "map", "num_players", "bid", "score", "rank", "new_rating")
+
+    def __init__(self, rows, player_ids, faction_ids):
+        """<rows> are (game_id, player_id, faction_id, round, group, map, num_players, bid, score, new_rating) with
+        each game's entries together and sorted by score, best first. The id lists must be sorted"""
+        self.player_ids = np.asarray(player_ids, dtype=np.int64)
+        self.faction_ids = np.asarray(faction_ids, dtype=np.int64)
+        game_ids, player_ids, faction_ids, rounds, groups, maps, num_players, bids, scores, new_ratings = (
+            zip(*rows) if rows else [()] * 10)
+        game_ids = np.asarray(game_ids, dtype=np.int64)
+
+        # Players and factions by position in the sorted id lists, groups and maps by name, games by first appearance
+        self.player = np.searchsorted(self.player_ids, np.asarray(player_ids, dtype=np.int64))
+        self.faction = np.searchsorted(self.faction_ids, np.asarray(faction_ids, dtype=np.int64))
+        self.groups, self.group = np.unique(np.asarray(groups, dtype=str), return_inverse=True)
+        self.maps, self.map = np.unique(np.asarray(maps, dtype=str), return_inverse=True)
+        new_game = np.ones(len(game_ids), dtype=bool)
+        new_game[1:] = game_ids[1:] != game_ids[:-1]
+        self.game = np.cumsum(new_game) - 1
+        self.game_ids = game_ids[new_game]
+
+        self.round = np.asarray(rounds, dtype=np.int64)
+        self.num_players = np.asarray(num_players, dtype=np.int64)
+        self.bid = np.asarray(bids, dtype=np.int64)
+        self.score = np.asarray(scores, dtype=np.int64)
+        self.new_rating = np.asarray(new_ratings, dtype=np.int64)
+
+        # Place within the game: position in the game's segment
+        game_starts = np.flatnonzero(new_game)
+        self.rank = np.arange(len(game_ids)) - game_starts[self.game] + 1
+
+    def __len__(self):
+        return len(self.game)
+
+
+def player_stats_table(columns, high_rating_threshold=HIGH_RATING_THRESHOLD):
+    """Returns every player's stats as a dict of arrays indexed like <columns.player_ids>:
+    num_games, score_sum, bid_sum, relative_score_sum (sum of score - game average score),
+    placements (players x groups x [1st, 2nd, 3rd, total]), faction_games (players x factions) and
+    high_rating (highest rating from their <high_rating_threshold>th game on, -1 if they have played fewer)"""
+    num_players, num_groups = len(columns.player_ids), len(columns.groups)
+    num_games = np.bincount(columns.player, minlength=num_players)
+    score_sum = np.bincount(columns.player, weights=columns.score, minlength=num_players).astype(np.int64)
+    bid_sum = np.bincount(columns.player, weights=columns.bid, minlength=num_players).astype(np.int64)
+    game_average = (np.bincount(columns.game, weights=columns.score, minlength=len(columns.game_ids))
+                    / np.maximum(np.bincount(columns.game, minlength=len(columns.game_ids)), 1))
+    relative_score_sum = np.bincount(columns.player, weights=columns.score - game_average[columns.game],
+                                     minlength=num_players)
+
+    # Places 1-3 (anything worse lands in a discarded 4th column) and totals, per player and group
+    player_group = columns.player * num_groups + columns.group
+    placed = np.bincount(player_group * (PLACES + 1) + np.minimum(columns.rank, PLACES + 1) - 1,
+                         minlength=num_players * num_groups * (PLACES + 1)).reshape(num_players, num_groups, PLACES + 1)
+    placements = np.concatenate([placed[:, :, :PLACES], placed.sum(axis=2, keepdims=True)], axis=2)
+
+    num_factions = len(columns.faction_ids)
+    faction_games = np.bincount(columns.player * num_factions + columns.faction,
+                                minlength=num_players * num_factions).reshape(num_players, num_factions)
+
+    # Each player's games in play order (round, group, game) form a sorted segment, so the position in the segment
+    # is the number of games played before
+    order = np.lexsort((columns.game, columns.group, columns.round, columns.player))
+    segment_starts = np.searchsorted(columns.player[order], np.arange(num_players))
+    game_number = np.arange(len(order)) - segment_starts[columns.player[order]] + 1
+    counted = order[game_number >= high_rating_threshold]
+    high_rating = np.full(num_players, -1, dtype=np.int64)
+    np.maximum.at(high_rating, columns.player[counted], columns.new_rating[counted])
+
+    return {"num_games": num_games, "score_sum": score_sum, "bid_sum": bid_sum,
+            "relative_score_sum": relative_score_sum, "placements": placements, "faction_games": faction_games,
+            "high_rating": high_rating}
@@ -0,0 +1,18 @@
+import numpy as np
+
+from elo import pad_games
+
+
+def tally_head_to_head(matrix, index, games):
+    """Adds games (lists of (player_id, score)) to a (players x players x [W, L, D]) matrix with vectorized
+    score comparisons within each game"""
+    if not games:
+        return
+    players, mask = pad_games([[index[player_id] for player_id, score in game] for game in games])
+    scores, _ = pad_games([[score for player_id, score in game] for game in games])
+    outcomes = np.sign(scores[:, :, np.newaxis] - scores[:, np.newaxis, :])  # 1 win, -1 loss, 0 draw
+    pair_mask = mask[:, :, np.newaxis] & mask[:, np.newaxis, :] & ~np.eye(mask.shape[1], dtype=bool)
+
+    game_nums, rows, cols = np.nonzero(pair_mask)
+    outcome_cols = np.array([1, 2, 0])[outcomes[game_nums, rows, cols] + 1]  # -> column 0 W, 1 L, 2 D
+    np.add.at(matrix, (players[game_nums, rows], players[game_nums, cols], outcome_cols), 1)
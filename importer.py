@@ -0,0 +1,153 @@
+import csv
+import datetime as dt
+import io
+import json
+
+from constants import FACTIONS, MAPS, EMOJIS, STARTING_RATING, BULK_CHUNK_SIZE
+from database_manager import Game, GameHistory, Player, Faction, bulk_insert_rows
+from elo import recalculate_elos
+
+CSV_COLUMNS = ["bga_id", "round", "group", "map", "player", "faction", "bid", "score"]
+
+
+# Parsing
+def parse_games_csv(text):
+    """Returns a list of game dicts from CSV text with a header of CSV_COLUMNS and one row per player.
+    Consecutive rows with the same bga_id make up one game"""
+    reader = csv.DictReader(io.StringIO(text))
+    missing_columns = [column for column in CSV_COLUMNS if column not in (reader.fieldnames or [])]
+    if missing_columns:
+        raise ValueError(f"CSV is missing columns: {', '.join(missing_columns)}")
+
+    games = []
+    for row in reader:
+        row = {column: (row[column] or "").strip() for column in CSV_COLUMNS}
+        if not games or games[-1]["bga_id"] != row["bga_id"]:
+            games.append({"bga_id": row["bga_id"], "round": row["round"], "group": row["group"],
+                          "map": row["map"], "entries": []})
+        games[-1]["entries"].append({"player": row["player"], "faction": row["faction"],
+                                     "bid": row["bid"], "score": row["score"]})
+    return games
+
+
+def parse_games_json(text):
+    """Returns a list of game dicts from JSON text in the form
+    [{"bga_id", "round", "group", "map", "entries": [{"player", "faction", "bid", "score"}, ...]}, ...]"""
+    games = json.loads(text)
+    if not isinstance(games, list):
+        raise ValueError("JSON must be a list of games")
+    return games
+
+
+def parse_games(filename, text):
+    """Parses an uploaded .csv or .json file"""
+    if filename.lower().endswith(".json"):
+        return parse_games_json(text)
+    return parse_games_csv(text)
+
+
+# Validation
+def clean_game(game):
+    """Returns a copy of a parsed game with its numeric fields as ints, raising ValueError if it is malformed"""
+    try:
+        return {
+            "bga_id": int(game["bga_id"]),
+            "round": int(game["round"]),
+            "group": str(game["group"]),
+            "map": str(game["map"]),
+            "entries": [{"player": str(entry["player"]), "faction": str(entry["faction"]),
+                         "bid": int(entry["bid"]), "score": int(entry["score"])} for entry in game["entries"]]
+        }
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError(f"Game {game.get('bga_id', '?') if isinstance(game, dict) else '?'} is malformed "
+                         f"({error!r})")
+
+
+def validate_games(games, player_ids, faction_ids, existing_game_ids):
+    """Returns (cleaned games, error messages). Players and factions are checked against the {name: id} dicts
+    loaded from the database, factions and maps also against constants"""
+    map_names = {map_name for map_name, label in MAPS}
+    cleaned_games, errors, seen_game_ids = [], [], set()
+    for game in games:
+        try:
+            game = clean_game(game)
+        except ValueError as error:
+            errors.append(str(error))
+            continue
+
+        label = f"Game {game['bga_id']}"
+        if game["bga_id"] in existing_game_ids or game["bga_id"] in seen_game_ids:
+            errors.append(f"{label}: game ID already exists")
+        seen_game_ids.add(game["bga_id"])
+        if game["round"] < 1:
+            errors.append(f"{label}: invalid round {game['round']}")
+        if game["group"] not in EMOJIS:
+            errors.append(f"{label}: unknown group {game['group']}")
+        if game["map"] not in map_names:
+            errors.append(f"{label}: unknown map {game['map']}")
+        if not 2 <= len(game["entries"]) <= 5:
+            errors.append(f"{label}: must have 2-5 players")
+        if len({entry["player"] for entry in game["entries"]}) != len(game["entries"]):
+            errors.append(f"{label}: a player is listed twice")
+        if len({entry["faction"] for entry in game["entries"]}) != len(game["entries"]):
+            errors.append(f"{label}: a faction is listed twice")
+        for entry in game["entries"]:
+            if entry["player"] not in player_ids:
+                errors.append(f"{label}: unknown player {entry['player']}")
+            if entry["faction"] not in FACTIONS or entry["faction"] not in faction_ids:
+                errors.append(f"{label}: unknown faction {entry['faction']}")
+            if not 0 <= entry["bid"] <= 40:
+                errors.append(f"{label}: bid {entry['bid']} is not between 0 and 40")
+            if not 0 <= entry["score"] <= 250:
+                errors.append(f"{label}: score {entry['score']} is not between 0 and 250")
+        cleaned_games.append(game)
+    return cleaned_games, errors
+
+
+def parsed_game_ids(games):
+    """Returns the set of game IDs of parsed games, skipping malformed ones (validation reports those)"""
+    game_ids = set()
+    for game in games:
+        try:
+            game_ids.add(int(game["bga_id"]))
+        except (KeyError, TypeError, ValueError):
+            pass
+    return game_ids
+
+
+# Import
+def import_games(db, games):
+    """Validates and inserts parsed games in one transaction, then recalculates ratings from the earliest
+    imported round in a single replay. Returns a list of error messages (nothing is written if there are any)"""
+    player_ids = dict(db.session.execute(db.select(Player.name, Player.id)).all())
+    faction_ids = dict(db.session.execute(db.select(Faction.name, Faction.id)).all())
+    game_ids = list(parsed_game_ids(games))
+    existing_game_ids = {game_id for start in range(0, len(game_ids), BULK_CHUNK_SIZE)
+                         for game_id in db.session.execute(db.select(Game.bga_id).where(
+                             Game.bga_id.in_(game_ids[start:start + BULK_CHUNK_SIZE]))).scalars()}
+    games, errors = validate_games(games, player_ids, faction_ids, existing_game_ids)
+    if errors:
+        return errors
+    if not games:
+        return ["No games to import"]
+
+    # Ratings are placeholders until the replay below, which also fills in old ratings
+    created_at = dt.datetime.now()
+    game_rows, entry_rows = [], []
+    for game in games:
+        game_rows.append({"bga_id": game["bga_id"], "round": game["round"], "group": game["group"],
+                          "map": game["map"], "num_players": len(game["entries"])})
+        for entry in game["entries"]:
+            entry_rows.append({"player_id": player_ids[entry["player"]], "faction_id": faction_ids[entry["faction"]],
+                               "game_id": game["bga_id"], "bid": entry["bid"], "score": entry["score"],
+                               "old_rating": STARTING_RATING, "new_rating": STARTING_RATING,
+                               "created_at": created_at})
+
+    try:
+        bulk_insert_rows(db, Game, game_rows)
+        bulk_insert_rows(db, GameHistory, entry_rows)
+        recalculate_elos(db, from_round=min(game["round"] for game in games))
+    except Exception:
+        db.session.rollback()
+        raise
+    return []
@@ -0,0 +1,145 @@
+import json
+import logging
+from threading import Thread
+import time
+
+from backtest import load_batches, run_sweep
+from constants import RECALCULATION_STALE_AFTER, RECALCULATION_ATTEMPTS, JOB_PROGRESS_INTERVAL, BACKTEST_STALE_AFTER
+from database_manager import (create_recalculation_job, update_recalculation_job, create_backtest_job,
+                              update_backtest_job, get_league_version, utc_now)
+from elo import recalculate_elos, LeagueDataChanged
+
+logger = logging.getLogger(__name__)
+
+
+def start_recalculation(app, db, from_round=None, on_success=None):
+    """Queues a recalculation and runs it in a background thread, so no request waits for the replay.
+    Returns the job id, or None if a recalculation is already active in any worker"""
+    job_id = create_recalculation_job(db, from_round, RECALCULATION_STALE_AFTER)
+    if job_id is not None:
+        Thread(target=run_recalculation, args=(app, db, job_id, from_round, on_success),
+               name=f"recalculation-{job_id}", daemon=True).start()
+    return job_id
+
+
+def run_recalculation(app, db, job_id, from_round, on_success=None):
+    """Runs a recalculation job, recording its progress (rounds replayed) on the job record. The new ratings are
+    published in one transaction together with the league version, so readers see all old or all new ratings.
+    If the league data changes while the replay runs, the stale results are dropped and the job reruns"""
+    with app.app_context():
+        update_recalculation_job(db, job_id, status="running", started_at=utc_now())
+        last_update = 0
+
+        def progress(rounds_done, rounds_total):
+            nonlocal last_update
+            if time.monotonic() - last_update >= JOB_PROGRESS_INTERVAL or rounds_done == rounds_total:
+                update_recalculation_job(db, job_id, rounds_done=rounds_done, rounds_total=rounds_total)
+                last_update = time.monotonic()
+
+        try:
+            for attempt in range(RECALCULATION_ATTEMPTS):
+                try:
+                    recalculate_elos(db, from_round, progress, expected_version=get_league_version(db)[0])
+                    break
+                except LeagueDataChanged:
+                    logger.warning("League data changed during recalculation job %s, rerunning", job_id)
+            else:
+                raise LeagueDataChanged(f"League data changed during all {RECALCULATION_ATTEMPTS} attempts")
+        except Exception as error:
+            db.session.rollback()
+            logger.exception("Recalculation job %s failed", job_id)
+            update_recalculation_job(db, job_id, status="failed", active=None, finished_at=utc_now(),
+                                     error=repr(error)[:500])
+            return
+
+        update_recalculation_job(db, job_id, status="succeeded", active=None, finished_at=utc_now())
+        if on_success is not None:
+            try:
+                on_success()
+            except Exception:
+                logger.exception("Post-recalculation step failed for job %s", job_id)
+
+
+def start_backtest(app, db, parameter_sets):
+    """Queues a backtest of the parameter sets and runs it in a background thread, so the sweep doesn't hold a request
+    past the worker timeout. Returns the job id, or None if a backtest is already active in any worker"""
+    job_id = create_backtest_job(db, len(parameter_sets), BACKTEST_STALE_AFTER)
+    if job_id is not None:
+        Thread(target=run_backtest, args=(app, db, job_id, parameter_sets), name=f"backtest-{job_id}",
+               daemon=True).start()
+    return job_id
+
+
+def run_backtest(app, db, job_id, parameter_sets):
+    """Runs a backtest job, recording its progress (parameter sets done) on the job record and storing the results
+    there, where every worker can read them"""
+    with app.app_context():
+        update_backtest_job(db, job_id, status="running", started_at=utc_now())
+        last_update = 0
+
+        def progress(sets_done, num_sets):
+            nonlocal last_update
+            if time.monotonic() - last_update >= JOB_PROGRESS_INTERVAL or sets_done == num_sets:
+                update_backtest_job(db, job_id, sets_done=sets_done)
+                last_update = time.monotonic()
+
+        try:
+            league_version = get_league_version(db)[0]
+            batches, num_players = load_batches(db)
+            db.session.rollback()  # Don't hold the read transaction open during the sweep
+            results = run_sweep(batches, num_players, parameter_sets, progress=progress)
+        except Exception as error:
+            db.session.rollback()
+            logger.exception("Backtest job %s failed", job_id)
+            update_backtest_job(db, job_id, status="failed", active=None, finished_at=utc_now(),
+                                error=repr(error)[:500])
+            return
+
+        update_backtest_job(db, job_id, status="succeeded", active=None, finished_at=utc_now(),
+                            league_version=league_version, results=json.dumps(results))
+
+
+def status_summary(job, steps_done, steps_total):
+    """Returns the fields every job summary has: its status, the percentage of its steps done, its duration in
+    seconds so far (None until it starts) and any error"""
+    if job.started_at is None:
+        duration = None
+    else:
+        duration = ((job.finished_at or utc_now()) - job.started_at).total_seconds()
+    return {
+        "id": job.id,
+        "status": job.status,
+        "percent_done": 100 if job.status == "succeeded" else
+                        int(100 * steps_done / steps_total) if steps_total else 0,
+        "duration": duration,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() + "Z",
+    }
+
+
+def job_summary(job):
+    """Returns a job record as a JSON-friendly dict for the polling endpoint"""
+    if job is None:
+        return None
+    return {
+        **status_summary(job, job.rounds_done, job.rounds_total),
+        "from_round": job.from_round,
+        "rounds_done": job.rounds_done,
+        "rounds_total": job.rounds_total,
+    }
+
+
+def backtest_summary(job, with_results=False):
+    """Returns a backtest job record as a JSON-friendly dict for the polling endpoint, with its results (best
+    first) if asked for"""
+    if job is None:
+        return None
+    summary = {
+        **status_summary(job, job.sets_done, job.grid_size),
+        "grid_size": job.grid_size,
+        "sets_done": job.sets_done,
+        "league_version": job.league_version,
+    }
+    if with_results:
+        summary["results"] = json.loads(job.results) if job.results else []
+    return summary
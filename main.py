@@ -1,32 +1,43 @@
 import datetime as dt
-from io import BytesIO
+from hashlib import sha1
+from hmac import compare_digest
 import os
 
-from flask import Flask, render_template, redirect, url_for, flash, Response
+import click
+from flask import (Flask, render_template, stream_template, redirect, url_for, flash, Response, request, jsonify,
+                   abort, g)
 from flask_bootstrap import Bootstrap5
 from flask_login import login_user, LoginManager, current_user, logout_user
+from werkzeug.http import is_resource_modified
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-import numpy as np
-
-from constants import STARTING_RATING, RATING_FIG_YRANGE, HIGH_RATING_THRESHOLD, EMOJIS
-from database_manager import db, Player, Faction, Game, GameHistory, User
-from database_manager import (get_player_data, get_latest_round, get_latest_results, get_all_games, get_num_games,
-                              split_results, get_player_rating, update_player_rating, get_player,
-                              get_player_game_history, get_rating_history, get_high_rating, get_most_played_faction,
-                              get_results_highlights, get_faction_bg_color, get_score_stats, get_head_to_head,
-                              get_col_spans)
+from constants import (STARTING_RATING, PLOT_CACHE_SIZE, PLOT_POOL_WORKERS, PLOT_QUEUE_LIMIT, PLOT_RENDER_TIMEOUT,
+                       PLOT_BACKGROUND_WORKERS, EMOJIS, SLOW_QUERY_MS, N_PLUS_ONE_THRESHOLD, RECALCULATION_STALE_AFTER,
+                       MOVERS_COUNT, SIMULATIONS, SIMULATION_POOL_WORKERS, SIMULATION_PARALLEL_THRESHOLD, GROUP_MOVES,
+                       BACKTEST_MAX_SETS, RESULTS_ROUNDS_PER_PAGE)
+from database_manager import db, Player, Faction, User, engine_options, configure_sqlite
+from database_manager import (get_player_data, get_col_spans, init_league_version, get_league_version,
+                              bump_league_version, get_latest_recalculation_job, is_recalculation_active,
+                              get_latest_backtest_job, get_latest_lineups)
 from decorators import admin_required
-from elo import calculate_new_elos, recalculate_elos
-from forms import AddPlayerForm, AddFactionForm, AddGameForm, RegisterForm, LoginForm
+from plots import render_placeholder, PlotCache, PlotRenderer
+from simulation import RoundSimulator
+from faction_analytics import BREAKDOWNS, METRICS
+from snapshot import SnapshotHolder
+from forms import AddPlayerForm, AddFactionForm, AddGameForm, ImportGamesForm, BacktestForm, RegisterForm, LoginForm
+from importer import parse_games, import_games
+from backtest import parameter_grid, parse_values
+from jobs import start_recalculation, job_summary, start_backtest, backtest_summary
+from metrics import RequestMetrics
+from migrations import run_migrations
 
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.environ.get("FLASK_KEY")
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DB_URI", "sqlite:///tm_data.db")
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(os.environ)
 register_code = os.environ.get("REGISTER_CODE")
+metrics_token = os.environ.get("METRICS_TOKEN")  # Bearer token for the /metrics scraper, admin only if not set
 Bootstrap5(app)
 
 # Configure Flask login
@@ -43,67 +54,276 @@ def load_user(user_id):
 # Prepare database
 db.init_app(app)
 with app.app_context():
-    db.create_all()
+    configure_sqlite(db.engine)
+    for migration in run_migrations(db):
+        app.logger.warning("Applied migration %s", migration)
+    init_league_version(db)
+
+    # Per-endpoint latency and SQL metrics, registered first so every other hook's queries are counted
+    request_metrics = RequestMetrics()
+    request_metrics.init_app(app, db.engine)
+
+# Per-worker caches are keyed by the league version (or a version read from the database), never cleared on a write:
+# a write only runs in one worker, so clearing would leave every other worker serving the old pages
+
+# Rendered home page as (league version, html), kept per worker
+home_page_cache = {}
+
+# Rendered results pages as {(page, is latest page, logged in): (results revision, html)}, kept per worker. A page
+# only changes when a replay reaches its rounds, so pages of old rounds stay cached however many rounds follow
+results_page_cache = {}
+
+# Public pages are revalidated against the league version (ETag/Last-Modified) before any other query runs
+PUBLIC_ENDPOINTS = {"home", "get_profile", "rating_system", "head_to_head", "head_to_head_json",
+                    "rating_history_json", "standings", "round_odds", "factions", "get_faction_fig",
+                    "faction_analytics"}
+
+# Public pages read the league from this worker's snapshot (as g.snapshot), so the version check is their only query.
+# /results validates against its own revision instead of the league version
+SNAPSHOT_ENDPOINTS = PUBLIC_ENDPOINTS | {"get_all_results", "get_rating_fig"}
+league_snapshots = SnapshotHolder()
+
+# Rendered rating plots, kept per worker and rendered in a process pool
+plot_cache = PlotCache(PLOT_CACHE_SIZE)
+plot_renderer = PlotRenderer(plot_cache, PLOT_POOL_WORKERS, PLOT_QUEUE_LIMIT, PLOT_RENDER_TIMEOUT,
+                             PLOT_BACKGROUND_WORKERS)
+plot_placeholder = {}
+
+# Next-round forecast, kept per worker for the latest league version
+round_simulator = RoundSimulator(SIMULATION_POOL_WORKERS, SIMULATION_PARALLEL_THRESHOLD)
+
+
+@app.before_request
+def check_league_version():
+    if request.endpoint in SNAPSHOT_ENDPOINTS and request.method in ("GET", "HEAD"):
+        g.league_version, g.league_updated_at = get_league_version(db)
+        if request.endpoint in PUBLIC_ENDPOINTS:
+            # The header differs for logged in users and some pages take query args, so both are part of the ETag
+            g.etag = f"{g.league_version}-{int(current_user.is_authenticated)}"
+            if request.query_string:
+                g.etag += "-" + sha1(request.query_string).hexdigest()[:16]
+            if not is_resource_modified(request.environ, etag=g.etag, last_modified=g.league_updated_at):
+                return Response(status=304)
+        g.snapshot = league_snapshots.get(db, g.league_version)
+
+
+@app.after_request
+def add_league_validators(response):
+    if "etag" in g and response.status_code in (200, 304):
+        response.set_etag(g.etag)
+        response.last_modified = g.league_updated_at
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        response.vary.add("Cookie")
+    return response
 
 
 # Routes
 @app.route('/')
 def home():
-    player_data = get_player_data(db)
-    latest_results = get_latest_results(db)
-    num_games = get_num_games(db, player_data)
-    return render_template('index.html', player_data=player_data,
-                           latest_results=latest_results, num_games=num_games, emojis=EMOJIS)
+    # The header differs for logged in users, so they get their own copy
+    cached = home_page_cache.get(current_user.is_authenticated)
+    if cached is None or cached[0] != g.snapshot.version:
+        player_data, num_games = g.snapshot.get_leaderboard()
+        latest_results = g.snapshot.get_latest_results()
+        movers_round, risers, fallers = g.snapshot.get_movers(MOVERS_COUNT)
+        cached = (g.snapshot.version, render_template('index.html', player_data=player_data,
+                                                    latest_results=latest_results, num_games=num_games,
+                                                    movers_round=movers_round, risers=risers, fallers=fallers,
+                                                    emojis=EMOJIS))
+        home_page_cache[current_user.is_authenticated] = cached
+    return cached[1]
+
+
+def stream_and_cache(cache, key, revision, chunks):
+    """Yields the chunks of a streamed template, then caches the whole page as (revision, html)"""
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    cache[key] = (revision, "".join(parts))
 
 
 @app.route('/results')
-def get_all_results():
-    all_games_data = get_all_games(db)
-    all_results = split_results(all_games_data)
-    return render_template('results.html', results=all_results, emojis=EMOJIS)
+@app.route('/results/page/<int:page>')
+def get_all_results(page=None):
+    first_round, latest_round = g.snapshot.get_round_range()
+    if latest_round is None:
+        return render_template('results.html', results={}, emojis=EMOJIS, page=None)
+
+    # Page n holds rounds (n - 1) * RESULTS_ROUNDS_PER_PAGE + 1 to n * RESULTS_ROUNDS_PER_PAGE, newest first
+    latest_page = (latest_round - 1) // RESULTS_ROUNDS_PER_PAGE + 1
+    first_page = (first_round - 1) // RESULTS_ROUNDS_PER_PAGE + 1
+    page = latest_page if page is None else page
+    if not first_page <= page <= latest_page:
+        abort(404)
+    last_page_round = page * RESULTS_ROUNDS_PER_PAGE
+    is_latest = page == latest_page
+
+    # Validated against the revision of the page's rounds rather than the league version, which moves every game
+    revision = g.snapshot.get_results_revision(last_page_round)
+    etag = f"results-{page}-{int(is_latest)}-{revision}-{int(current_user.is_authenticated)}"
+    if not is_resource_modified(request.environ, etag=etag):
+        response = Response(status=304)
+    else:
+        cache_key = (page, is_latest, current_user.is_authenticated)
+        cached = results_page_cache.get(cache_key)
+        if cached is not None and cached[0] == revision:
+            response = Response(cached[1])
+        else:
+            results = g.snapshot.get_results_page(last_page_round - RESULTS_ROUNDS_PER_PAGE + 1, last_page_round)
+            # Streamed, so the first rounds reach the browser while the rest render
+            response = Response(stream_and_cache(results_page_cache, cache_key, revision, stream_template(
+                'results.html', results=results, emojis=EMOJIS, page=page,
+                older_page=page - 1 if page > first_page else None, newer_page=None if is_latest else page + 1)))
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
 
 
 @app.route('/profile/<player_name>')
 def get_profile(player_name):
-    player = get_player(db, player_name)
-    game_history = get_player_game_history(db, player_name)
+    profile = g.snapshot.get_profile_data(player_name)
+    if profile is None:
+        abort(404)
+    player, profile_data, game_history = profile
+    profile_data["head_to_head"] = g.snapshot.get_head_to_head_record(player)
     col_spans = get_col_spans(game_history)
-    most_played_faction = get_most_played_faction(db, player_name)
-    profile_data = {
-        "player_name": player_name,
-        "current_rating": player.current_rating,
-        "num_games": get_num_games(db, [player])[player.name],
-        "high_rating": get_high_rating(db, player_name, HIGH_RATING_THRESHOLD),
-        "results_highlights": get_results_highlights(db, player_name, game_history),
-        "most_played_faction": most_played_faction,
-        "faction_bg_color": get_faction_bg_color(db, most_played_faction),
-        "score_stats": get_score_stats(db, player_name, game_history),
-        "head_to_head": get_head_to_head(db, player_name)
-    }
     return render_template('profile.html',
                            profile_data=profile_data, game_history=game_history, col_spans=col_spans)
 
 
-@app.route('/get-rating-plot/<player_name>')
-def get_rating_fig(player_name):
-    rating_history = get_rating_history(db, player_name)
-    round_nums, ratings = zip(*rating_history)
+@app.route('/head-to-head')
+def head_to_head():
+    player_names, table = g.snapshot.get_head_to_head_table()
+    return render_template('head-to-head.html', player_names=player_names, table=table)
+
 
+@app.route('/api/head-to-head')
+def head_to_head_json():
+    player_names, table = g.snapshot.get_head_to_head_table()
+    return jsonify(players=player_names, records=table.tolist())
 
-    # Create figure
-    fig = Figure()
-    axis = fig.add_subplot(1, 1, 1)
-    axis.plot(*zip(*rating_history), color="black")
-    axis.set_xticks(np.arange(0, get_latest_round(db) + 1))
-    axis.set_yticks(np.arange(*RATING_FIG_YRANGE))
-    axis.set_xlabel("Round")
-    axis.set_ylabel("Rating")
-    axis.axhline(1000, ls="--", color="gray", linewidth=1)
 
-    # Output figure
-    output = BytesIO()
-    FigureCanvasAgg(fig).print_png(output)
-    return Response(output.getvalue(), mimetype="image/png")
+@app.route('/api/rating-history')
+def rating_history_json():
+    player_names = request.args.get("players")
+    player_names = player_names.split(",") if player_names else None
+    since_round = request.args.get("since_round", type=int)
+    rating_histories = g.snapshot.get_all_rating_histories(player_names, since_round)
+    return jsonify(version=g.league_version, players=rating_histories)
+
+
+@app.route('/get-rating-plot/<player_name>')
+def get_rating_fig(player_name):
+    version = g.snapshot.get_rating_history_version(player_name)
+    if version is None or version[0] == 0:
+        abort(404)
+    etag = sha1(repr((player_name, version)).encode()).hexdigest()
+    if etag in request.if_none_match:
+        return conditional_response(Response(status=304), etag)
+
+    png = plot_cache.get(player_name, version)
+    if png is None:
+        png = plot_renderer.render(player_name, version, g.snapshot.get_rating_history(player_name),
+                                   g.snapshot.get_latest_round())
+    if png is None:
+        # Renderer is saturated or slow: serve the last cached plot or a placeholder, and don't let it be cached
+        response = Response(plot_cache.get_latest(player_name) or get_plot_placeholder(), mimetype="image/png")
+        response.cache_control.no_store = True
+        return response
+    return conditional_response(Response(png, mimetype="image/png"), etag)
+
+
+@app.route('/standings/<int:round_num>')
+def standings(round_num):
+    standings_data = g.snapshot.get_standings(round_num)
+    if not standings_data:
+        abort(404)
+    previous_round, next_round = g.snapshot.get_adjacent_rounds(round_num)
+    return render_template('standings.html', round_num=round_num, standings=standings_data,
+                           previous_round=previous_round, next_round=next_round)
+
+
+@app.route('/odds')
+def round_odds():
+    latest_round, forecast = round_simulator.get_forecast(g.snapshot.version, g.snapshot.get_latest_lineups,
+                                                          SIMULATIONS)
+    return render_template('odds.html', latest_round=latest_round, forecast=forecast, simulations=SIMULATIONS,
+                           group_moves=GROUP_MOVES, emojis=EMOJIS)
+
+
+@app.route('/factions')
+def factions():
+    faction_data = g.snapshot.get_faction_leaderboard()
+    return render_template('factions.html', faction_data=faction_data)
+
+
+@app.route('/factions/analytics')
+def faction_analytics():
+    # Pre-aggregated once per league version in the snapshot, so each filter only sums the matching rounds
+    analytics = g.snapshot.faction_analytics
+    map_name = request.args.get("map")
+    group = request.args.get("group")
+    filters = {"map_name": map_name if map_name in analytics.maps else None,
+               "group": group if group in analytics.groups else None,
+               "first_round": request.args.get("first_round", type=int),
+               "last_round": request.args.get("last_round", type=int)}
+    breakdown = request.args.get("by") if request.args.get("by") in BREAKDOWNS else "map"
+    metric = request.args.get("metric") if request.args.get("metric") in METRICS[1:] else "win_rate"
+    return render_template('faction-analytics.html', analytics=analytics, filters=filters,
+                           results=analytics.query(**filters), breakdown=breakdown, breakdowns=BREAKDOWNS,
+                           metric=metric, round_range=analytics.round_range(),
+                           colors={name: faction.color for name, faction in g.snapshot.factions.items()})
+
+
+@app.route('/get-faction-plot/<faction_name>')
+def get_faction_fig(faction_name):
+    # Nothing to plot until a game has been played
+    rating_history = g.snapshot.get_faction_rating_history(faction_name)
+    latest_round = g.snapshot.get_latest_round()
+    if rating_history is None or latest_round is None:
+        abort(404)
+
+    # Faction histories only change with the league version, which is also the ETag
+    cache_key = f"faction:{faction_name}"
+    png = plot_cache.get(cache_key, g.snapshot.version)
+    if png is None:
+        png = plot_renderer.render(cache_key, g.snapshot.version, rating_history, latest_round)
+    if png is None:
+        response = Response(plot_cache.get_latest(cache_key) or get_plot_placeholder(), mimetype="image/png")
+        response.cache_control.no_store = True
+        g.pop("etag")
+        return response
+    return Response(png, mimetype="image/png")
+
+
+def get_plot_placeholder():
+    """Returns the 'rendering...' PNG, rendering it once per worker"""
+    if "placeholder" not in plot_placeholder:
+        plot_placeholder["placeholder"] = render_placeholder()
+    return plot_placeholder["placeholder"]
+
+
+def refill_plot_cache():
+    """Renders the rating plots of the most recently active players, as many as the cache holds, in the background.
+    Plots are cached by rating history version, so other workers render the new plots on demand"""
+    snapshot = league_snapshots.get(db, get_league_version(db)[0])
+    player_names = snapshot.get_recently_active_players(PLOT_CACHE_SIZE)
+    rating_histories = snapshot.get_all_rating_histories(player_names)
+    versions = snapshot.get_rating_history_versions()
+    plot_renderer.render_all({player_name: (versions[player_name], rating_histories[player_name])
+                              for player_name in player_names}, snapshot.get_latest_round())
+
+
+def conditional_response(response, etag):
+    """Adds the validators to a rating plot response so clients revalidate instead of refetching"""
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route('/rating-system')
@@ -166,17 +386,76 @@ def logout():
 @app.route('/admin')
 @admin_required
 def admin():
-    return render_template('admin.html')
+    return render_template('admin.html', job=job_summary(get_latest_recalculation_job(db)))
+
+
+@app.route('/admin/backtest', methods=["GET", "POST"])
+@admin_required
+def admin_backtest():
+    form = BacktestForm()
+    if form.validate_on_submit():
+        grid = parameter_grid(*(parse_values(field.data) for field in [form.c, form.min_k, form.max_k,
+                                                                       form.k_numerator]))
+        if len(grid) > BACKTEST_MAX_SETS:
+            flash(f"That is {len(grid)} parameter sets, the limit is {BACKTEST_MAX_SETS}.", "error")
+        elif start_backtest(app, db, grid) is None:
+            flash("A backtest is already running!", "error")
+        else:
+            flash(f"Backtest of {len(grid)} parameter sets started!", "notice")
+            return redirect(url_for("admin_backtest"))
+    # Results are read from the latest successful job's record, so every worker shows the same run
+    backtest = backtest_summary(get_latest_backtest_job(db, status="succeeded"), with_results=True)
+    is_stale = backtest is not None and backtest["league_version"] != get_league_version(db)[0]
+    return render_template('admin-backtest.html', form=form, job=backtest_summary(get_latest_backtest_job(db)),
+                           backtest=backtest, is_stale=is_stale)
+
+
+@app.route('/admin/backtest/status')
+@admin_required
+def backtest_status():
+    return jsonify(job=backtest_summary(get_latest_backtest_job(db)))
+
+
+@app.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    slow_queries, n_plus_one = request_metrics.recent()
+    return render_template('admin-metrics.html', endpoints=request_metrics.snapshot(), slow_queries=slow_queries,
+                           n_plus_one=n_plus_one, started_at=request_metrics.started_at,
+                           slow_query_ms=SLOW_QUERY_MS, n_plus_one_threshold=N_PLUS_ONE_THRESHOLD)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # For the scraper (with the METRICS_TOKEN bearer token), or the admin. Not decided by the client address, since
+    # behind the reverse proxy every request comes from the proxy
+    auth = request.authorization
+    is_scraper = (bool(metrics_token) and auth is not None and auth.type == "bearer"
+                  and compare_digest(auth.token or "", metrics_token))
+    if not is_scraper and not (current_user.is_authenticated and current_user.id == 1):
+        abort(403)
+    return Response(request_metrics.prometheus_text(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route('/recalculate')
 @admin_required
 def recalculate():
-    recalculate_elos(db)
-    flash("Ratings recalculated!", "notice")
+    from_round = request.args.get("from_round", type=int)
+    if start_recalculation(app, db, from_round, on_success=refill_plot_cache) is None:
+        flash("A recalculation is already running!", "error")
+    elif from_round is None:
+        flash("Recalculation started!", "notice")
+    else:
+        flash(f"Recalculation from round {from_round} started!", "notice")
     return redirect(url_for('admin'))
 
 
+@app.route('/recalculate/status')
+@admin_required
+def recalculation_status():
+    return jsonify(job=job_summary(get_latest_recalculation_job(db)))
+
+
 @app.route('/add-player', methods=["GET", "POST"])
 @admin_required
 def add_player():
@@ -191,6 +470,7 @@ def add_player():
         else:
             new_player = Player(name=new_name, current_rating=STARTING_RATING)
             db.session.add(new_player)
+            bump_league_version(db)
             db.session.commit()
             flash("Player added!", "notice")
             return redirect(url_for("admin"))
@@ -212,6 +492,7 @@ def add_faction():
         else:
             new_faction = Faction(name=new_name, color=form.color.data, current_rating=STARTING_RATING)
             db.session.add(new_faction)
+            bump_league_version(db)
             db.session.commit()
             flash("Faction added!", "notice")
             return redirect(url_for("admin"))
@@ -235,56 +516,88 @@ def add_game():
     if form.validate_on_submit():
         new_game_id = form.bga_id.data
 
-        # Check if game ID exists
-        if db.session.execute(db.select(Game).where(Game.bga_id == new_game_id)).scalar():
-            flash("Game ID already exists!", "error")
+        if is_recalculation_active(db, RECALCULATION_STALE_AFTER):
+            flash("A recalculation is running, please add the game when it has finished.", "error")
             return redirect(url_for("admin"))
 
-        else:
-            # Add to games table
-            num_players = form.num_players.data
-            new_game = Game(
-                bga_id=new_game_id,
-                round=form.round.data,
-                group=form.group.data,
-                map=form.map.data,
-                num_players = num_players
-            )
-            db.session.add(new_game)
-            db.session.commit()
-
-            # Add to game_history table
-            game_results = []
-            for i in range(num_players):
-                player = db.session.execute(db.select(Player).where(Player.name == form[f"p{i+1}"].data)).scalar()
-                entry = GameHistory(
-                    player=player,
-                    faction=db.session.execute(db.select(Faction)
-                                               .where(Faction.name == form[f"p{i+1}_faction"].data)).scalar(),
-                    game=new_game,
-                    bid=form[f"p{i+1}_bid"].data,
-                    score=form[f"p{i+1}_score"].data,
-                    old_rating=get_player_rating(db, player.name),
-                    new_rating=STARTING_RATING,  # This is just a placeholder.
-                    created_at=dt.datetime.now()
-                )
-                game_results.append(entry)
-
-            # Compute new ratings and update game results
-                num_games = get_num_games(db, [entry.player for entry in game_results])
-                game_results = calculate_new_elos(game_results, num_games)
-
-            # Add updated entries to game_history table and update ratings in players table
-            for entry in game_results:
-                update_player_rating(db, player_name=entry.player.name, new_rating=entry.new_rating)
-                db.session.add(entry)
-                db.session.commit()
-
-            flash("Game added!", "notice")
+        # Inserted in bulk and rated by replaying from the game's round (also handles games added to old rounds)
+        game = {"bga_id": new_game_id, "round": form.round.data, "group": form.group.data, "map": form.map.data,
+                "entries": [{"player": form[f"p{i+1}"].data, "faction": form[f"p{i+1}_faction"].data,
+                             "bid": form[f"p{i+1}_bid"].data, "score": form[f"p{i+1}_score"].data}
+                            for i in range(form.num_players.data)]}
+        errors = import_games(db, [game])
+        if errors:
+            for error in errors:
+                flash(error, "error")
             return redirect(url_for("admin"))
 
+        flash("Game added!", "notice")
+        return redirect(url_for("admin"))
+
     return render_template('add-game.html', form=form)
 
 
+@app.route('/import-games', methods=["GET", "POST"])
+@admin_required
+def import_games_upload():
+    form = ImportGamesForm()
+    if form.validate_on_submit():
+        if is_recalculation_active(db, RECALCULATION_STALE_AFTER):
+            flash("A recalculation is running, please import the games when it has finished.", "error")
+            return render_template('import-games.html', form=form)
+
+        games_file = form.games_file.data
+        try:
+            games = parse_games(games_file.filename, games_file.read().decode("utf-8-sig"))
+        except ValueError as error:
+            flash(f"Could not read file: {error}", "error")
+            return render_template('import-games.html', form=form)
+
+        errors = import_games(db, games)
+        if errors:
+            for error in errors:
+                flash(error, "error")
+            return render_template('import-games.html', form=form)
+
+        refill_plot_cache()
+        flash(f"{len(games)} games imported!", "notice")
+        return redirect(url_for("admin"))
+
+    return render_template('import-games.html', form=form)
+
+
+@app.cli.command("import-games")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_games_command(path):
+    """Imports games from a .csv or .json file"""
+    with open(path, encoding="utf-8-sig") as games_file:
+        games = parse_games(path, games_file.read())
+    errors = import_games(db, games)
+    for error in errors:
+        click.echo(error, err=True)
+    if errors:
+        raise SystemExit(1)
+    click.echo(f"{len(games)} games imported")
+
+
+@app.cli.command("simulate-round")
+@click.option("--simulations", default=SIMULATIONS, show_default=True, help="number of simulated rounds")
+@click.option("--seed", type=int, help="random seed")
+def simulate_round_command(simulations, seed):
+    """Prints each player's odds for the next round"""
+    latest_round, lineups = get_latest_lineups(db)
+    start = dt.datetime.now()
+    forecast = round_simulator.forecast(lineups, simulations, seed)
+    click.echo(f"{simulations} simulations of round {latest_round} line-ups in "
+               f"{(dt.datetime.now() - start).total_seconds():.2f}s")
+    for group, odds in forecast:
+        labels = [str(place + 1) for place in range(len(odds))] + ["title", "up", "down"]
+        click.echo(f"\n{group.upper():<27}" + " ".join(f"{label:>6}" for label in labels))
+        for player in odds:
+            click.echo(f"{player['name'][:20]:<20} {player['rating']:>4}  "
+                       + " ".join(f"{chance:6.1%}" for chance in player["places"] + [player["title"], player["up"],
+                                                                                    player["down"]]))
+
+
 if __name__ == "__main__":
     app.run(debug=False)
@@ -0,0 +1,207 @@
+from collections import Counter, deque
+import datetime as dt
+import logging
+import re
+from threading import Lock
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+from constants import (SLOW_QUERY_MS, N_PLUS_ONE_THRESHOLD, METRICS_RECENT_LIMIT, LATENCY_BUCKETS_MS,
+                       QUERY_COUNT_BUCKETS)
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Fixed-bucket histogram, so memory stays bounded however many observations are recorded"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q-th quantile (the max if it's in the +Inf bucket)"""
+        if not self.count:
+            return None
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + (self.max,), self.counts):
+            cumulative += count
+            if cumulative >= q * self.count:
+                return min(upper_bound, self.max)
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+
+class EndpointMetrics:
+    """Aggregates for one endpoint: latency, SQL statements per request and SQL time per request"""
+
+    def __init__(self):
+        self.latency_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.sql_ms = Histogram(LATENCY_BUCKETS_MS)
+        self.statuses = Counter()
+        self.slow_queries = 0
+        self.n_plus_one = 0
+
+
+class RequestMetrics:
+    """Records per-endpoint request latency, SQL statement counts and SQL time using Flask request hooks and
+    SQLAlchemy engine events. Also logs slow queries and flags likely N+1 patterns (the same statement run more than
+    N_PLUS_ONE_THRESHOLD times in one request). Statements run outside a request (CLI, background jobs) aren't counted"""
+
+    def __init__(self):
+        self.endpoints = {}
+        self.recent_slow_queries = deque(maxlen=METRICS_RECENT_LIMIT)
+        self.recent_n_plus_one = deque(maxlen=METRICS_RECENT_LIMIT)
+        self.started_at = dt.datetime.now()
+        self._lock = Lock()
+
+    def init_app(self, app, engine):
+        """Registers the hooks. Call before any other before_request hook so their queries are counted too"""
+        app.before_request(self._start_request)
+        app.after_request(self._record_status)
+        app.teardown_request(self._finish_request)
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    # Flask hooks
+    def _start_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_statements = Counter()
+        g.metrics_sql_ms = 0
+        g.metrics_slow_queries = 0
+
+    def _record_status(self, response):
+        g.metrics_status = response.status_code
+        return response
+
+    def _finish_request(self, exception):
+        # Runs once the response (including a streamed one) is finished, or after an unhandled exception
+        if "metrics_start" not in g:
+            return
+        latency_ms = (time.perf_counter() - g.metrics_start) * 1000
+        endpoint = request.endpoint or "unmatched"
+        status = 500 if exception is not None else g.get("metrics_status", 500)
+        repeated = [(statement, count) for statement, count in g.metrics_statements.items()
+                    if count > N_PLUS_ONE_THRESHOLD]
+        for statement, count in repeated:
+            logger.warning("Possible N+1 in %s: statement run %d times: %s", endpoint, count, statement)
+
+        with self._lock:
+            metrics = self.endpoints.setdefault(endpoint, EndpointMetrics())
+            metrics.latency_ms.observe(latency_ms)
+            metrics.queries.observe(sum(g.metrics_statements.values()))
+            metrics.sql_ms.observe(g.metrics_sql_ms)
+            metrics.statuses[status] += 1
+            metrics.slow_queries += g.metrics_slow_queries
+            metrics.n_plus_one += len(repeated)
+            for statement, count in repeated:
+                self.recent_n_plus_one.appendleft((dt.datetime.now(), endpoint, count, statement))
+        g.pop("metrics_start")
+
+    # SQLAlchemy events
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info["metrics_query_start"].pop()) * 1000
+        endpoint = None
+        if has_request_context() and "metrics_start" in g:
+            endpoint = request.endpoint or "unmatched"
+            g.metrics_statements[statement_shape(statement)] += 1
+            g.metrics_sql_ms += elapsed_ms
+        if elapsed_ms > SLOW_QUERY_MS:
+            logger.warning("Slow query (%.1f ms) in %s: %s", elapsed_ms, endpoint or "no request", statement)
+            if endpoint is not None:
+                g.metrics_slow_queries += 1
+            with self._lock:
+                self.recent_slow_queries.appendleft((dt.datetime.now(), endpoint, elapsed_ms,
+                                                     statement_shape(statement)))
+
+    # Output
+    def snapshot(self):
+        """Returns a list of (endpoint, summary dict) sorted by total time spent, for the admin page"""
+        with self._lock:
+            summaries = [(endpoint, {
+                "requests": metrics.latency_ms.count,
+                "total_s": metrics.latency_ms.sum / 1000,
+                "mean_ms": metrics.latency_ms.mean(),
+                "p50_ms": metrics.latency_ms.quantile(0.5),
+                "p95_ms": metrics.latency_ms.quantile(0.95),
+                "p99_ms": metrics.latency_ms.quantile(0.99),
+                "max_ms": metrics.latency_ms.max,
+                "mean_queries": metrics.queries.mean(),
+                "max_queries": metrics.queries.max,
+                "mean_sql_ms": metrics.sql_ms.mean(),
+                "errors": sum(count for status, count in metrics.statuses.items() if status >= 500),
+                "slow_queries": metrics.slow_queries,
+                "n_plus_one": metrics.n_plus_one,
+            }) for endpoint, metrics in self.endpoints.items()]
+        return sorted(summaries, key=lambda summary: summary[1]["total_s"], reverse=True)
+
+    def recent(self):
+        """Returns copies of the recent slow queries (time, endpoint, ms, statement) and N+1 flags
+        (time, endpoint, count, statement), newest first"""
+        with self._lock:
+            return list(self.recent_slow_queries), list(self.recent_n_plus_one)
+
+    def prometheus_text(self):
+        """Returns the aggregates in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            for name, help_text, attribute, scale in [
+                    ("tm_request_duration_seconds", "Request latency", "latency_ms", 1000),
+                    ("tm_request_sql_statements", "SQL statements run per request", "queries", 1),
+                    ("tm_request_sql_duration_seconds", "Time spent in SQL per request", "sql_ms", 1000)]:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for endpoint, metrics in endpoints:
+                    histogram = getattr(metrics, attribute)
+                    cumulative = 0
+                    for upper_bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{format_bound(upper_bound / scale)}"}}'
+                                     f' {cumulative}')
+                    lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {histogram.sum / scale}')
+                    lines.append(f'{name}_count{{endpoint="{endpoint}"}} {histogram.count}')
+
+            lines += ["# HELP tm_requests_total Requests by endpoint and status", "# TYPE tm_requests_total counter"]
+            lines += [f'tm_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}'
+                      for endpoint, metrics in endpoints for status, count in sorted(metrics.statuses.items())]
+            for name, help_text, attribute in [
+                    ("tm_slow_queries_total", f"SQL statements slower than {SLOW_QUERY_MS} ms", "slow_queries"),
+                    ("tm_n_plus_one_total", f"Statements run more than {N_PLUS_ONE_THRESHOLD} times in one request",
+                     "n_plus_one")]:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                lines += [f'{name}{{endpoint="{endpoint}"}} {getattr(metrics, attribute)}'
+                          for endpoint, metrics in endpoints]
+        return "\n".join(lines) + "\n"
+
+
+def statement_shape(statement):
+    """Returns a statement with whitespace collapsed and expanded IN lists folded, so repeats of one query match"""
+    statement = re.sub(r"\s+", " ", statement).strip()
+    return re.sub(r"\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,?)+\)", "(?)", statement)
+
+
+def format_bound(value):
+    if value == float("inf"):
+        return "+Inf"
+    return f"{value:g}"
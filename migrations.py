@@ -0,0 +1,109 @@
+"""Versioned schema migrations. A new database is created from the models at the latest version. An existing one
+gets any missing tables from the models and then each pending migration in MIGRATIONS, in order, each in its own
+transaction together with the schema_version update. To change the schema, change the models and append a migration
+that brings an existing database to the same state (idempotently, so a half-applied SQLite migration can rerun).
+Migrations spell out the schema they change rather than reading it from the models, which keep changing"""
+from sqlalchemy import inspect, insert, update, select, text, MetaData, Table, Column, Integer, String, Index
+
+from constants import STARTING_RATING
+
+from database_manager import db, SchemaVersion, Game, RatingCheckpoint
+
+MIGRATION_LOCK_KEY = 7_436_001  # Postgres advisory lock held while migrating, so workers starting together don't race
+
+
+# Migrations
+def add_hot_path_indexes(connection):
+    """Adds the indexes for the player, game, round and score lookups. The tables are declared here with only the
+    indexed columns, so the migration stays the same whatever later happens to the models"""
+    metadata = MetaData()
+    player = Table("player", metadata, Column("current_rating", Integer))
+    game = Table("game", metadata, Column("bga_id", Integer), Column("round", Integer), Column("group", String(10)))
+    game_history = Table("game_history", metadata, Column("player_id", Integer), Column("game_id", Integer),
+                         Column("faction_id", Integer), Column("score", Integer))
+    faction_checkpoint = Table("faction_checkpoint", metadata, Column("faction_id", Integer), Column("round", Integer))
+    indexes = [
+        Index("ix_player_current_rating", player.c.current_rating),
+        Index("ix_game_round_group", game.c.round, game.c.group, game.c.bga_id),
+        Index("ix_game_history_player_id_game_id", game_history.c.player_id, game_history.c.game_id),
+        Index("ix_game_history_game_id_score", game_history.c.game_id, game_history.c.score),
+        Index("ix_game_history_faction_id", game_history.c.faction_id),
+        Index("ix_faction_checkpoint_faction_id_round", faction_checkpoint.c.faction_id, faction_checkpoint.c.round),
+    ]
+    for index in indexes:
+        index.create(connection, checkfirst=True)
+
+
+def add_checkpoint_standings(connection):
+    """Adds rank and rating change to the rating checkpoints and fills them in for existing rows"""
+    columns = {column["name"] for column in inspect(connection).get_columns(RatingCheckpoint.__tablename__)}
+    for column in ["rank", "rating_change"]:
+        if column not in columns:
+            connection.execute(text(f"ALTER TABLE rating_checkpoint ADD COLUMN {column} INTEGER"))
+    connection.execute(text("""
+        UPDATE rating_checkpoint SET
+            rank = CASE WHEN num_games > 0 THEN 1 + (
+                SELECT COUNT(*) FROM rating_checkpoint AS other
+                WHERE other.round = rating_checkpoint.round AND other.num_games > 0
+                    AND other.rating > rating_checkpoint.rating) END,
+            rating_change = rating - COALESCE((
+                SELECT previous.rating FROM rating_checkpoint AS previous
+                WHERE previous.player_id = rating_checkpoint.player_id AND previous.round = (
+                    SELECT MAX(earlier.round) FROM rating_checkpoint AS earlier
+                    WHERE earlier.round < rating_checkpoint.round)), :starting_rating)
+    """), {"starting_rating": STARTING_RATING})
+
+
+def drop_player_stats(connection):
+    """Drops the player stats tables, which the league snapshot replaced by computing the stats from the history"""
+    for table in ["player_faction_stats", "player_group_stats", "player_stats"]:
+        connection.execute(text(f"DROP TABLE IF EXISTS {table}"))
+
+
+def drop_checkpoint_high_ratings(connection):
+    """Drops the high rating from the rating checkpoints, since the league snapshot computes it from the history"""
+    columns = {column["name"] for column in inspect(connection).get_columns(RatingCheckpoint.__tablename__)}
+    if "high_rating" in columns:
+        connection.execute(text("ALTER TABLE rating_checkpoint DROP COLUMN high_rating"))
+
+
+MIGRATIONS = [
+    (1, "Add indexes for the hot query paths", add_hot_path_indexes),
+    (2, "Add standings (rank and rating change) to rating checkpoints", add_checkpoint_standings),
+    (3, "Drop the player stats tables", drop_player_stats),
+    (4, "Drop the high rating from rating checkpoints", drop_checkpoint_high_ratings),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# Runner
+def lock(connection):
+    """Serialises migrations across processes until the transaction ends (Postgres only, SQLite locks the file)"""
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+
+
+def get_schema_version(connection):
+    return connection.execute(select(SchemaVersion.version).where(SchemaVersion.id == 1)).scalar()
+
+
+def run_migrations(db):
+    """Creates missing tables and applies pending migrations. Returns the list of migrations applied"""
+    with db.engine.begin() as connection:
+        lock(connection)
+        is_new = not inspect(connection).has_table(Game.__tablename__)
+        db.metadata.create_all(connection)
+        if get_schema_version(connection) is None:
+            # Tables created from the models already match the latest version
+            connection.execute(insert(SchemaVersion).values(id=1, version=LATEST_VERSION if is_new else 0))
+
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        with db.engine.begin() as connection:
+            lock(connection)
+            if get_schema_version(connection) >= version:  # Already applied, possibly by another worker
+                continue
+            migrate(connection)
+            connection.execute(update(SchemaVersion).where(SchemaVersion.id == 1).values(version=version))
+            applied.append(f"{version}: {description}")
+    return applied
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+from concurrent.futures import TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from threading import Lock, BoundedSemaphore
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import numpy as np
+
+from constants import RATING_FIG_YRANGE
+from pools import LazyPool
+
+
+def render_rating_plot(rating_history, latest_round):
+    """Returns a player's rating history plot as PNG bytes"""
+    # Create figure
+    fig = Figure()
+    axis = fig.add_subplot(1, 1, 1)
+    axis.plot(*zip(*rating_history), color="black")
+    axis.set_xticks(np.arange(0, latest_round + 1))
+    axis.set_yticks(np.arange(*RATING_FIG_YRANGE))
+    axis.set_xlabel("Round")
+    axis.set_ylabel("Rating")
+    axis.axhline(1000, ls="--", color="gray", linewidth=1)
+
+    return figure_png(fig)
+
+
+def render_placeholder():
+    """Returns a 'rendering...' PNG shown while a plot is queued"""
+    fig = Figure()
+    fig.text(0.5, 0.5, "Rendering…", ha="center", va="center", fontsize=20, color="gray")
+    return figure_png(fig)
+
+
+def figure_png(fig):
+    """Returns a figure rendered as PNG bytes"""
+    output = BytesIO()
+    FigureCanvasAgg(fig).print_png(output)
+    return output.getvalue()
+
+
+class PlotCache:
+    """Bounded, least-recently-used cache of rendered plots, holding one (version, png) per player"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._plots = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, player_name, version):
+        """Returns the cached PNG for this player and version, else None"""
+        with self._lock:
+            cached = self._plots.get(player_name)
+            if cached is None or cached[0] != version:
+                return None
+            self._plots.move_to_end(player_name)
+            return cached[1]
+
+    def get_latest(self, player_name):
+        """Returns the player's cached PNG whatever its version, else None"""
+        with self._lock:
+            cached = self._plots.get(player_name)
+            return None if cached is None else cached[1]
+
+    def put(self, player_name, version, png):
+        with self._lock:
+            self._plots[player_name] = (version, png)
+            self._plots.move_to_end(player_name)
+            while len(self._plots) > self.max_size:
+                self._plots.popitem(last=False)
+
+
+class PlotRenderer:
+    """Renders rating plots in a process pool so the CPU-bound work stays off the request thread.
+    Finished plots are put into <cache>, including ones whose request has already timed out. Background renders
+    (render_all) get their own pool of <background_workers>, so request renders never queue behind them"""
+
+    def __init__(self, cache, max_workers, queue_limit, timeout, background_workers=1):
+        self.cache = cache
+        self.timeout = timeout
+        self._slots = BoundedSemaphore(queue_limit)
+        self._pools = {False: LazyPool(max_workers), True: LazyPool(background_workers)}  # {background: pool}
+        self._background_futures = []
+
+    def _submit(self, player_name, version, rating_history, latest_round, background):
+        """Submits a render whose result goes into the cache. Request renders hold a queue slot until they finish"""
+        def on_done(future):
+            if not background:
+                self._slots.release()
+            if not future.cancelled() and future.exception() is None:
+                self.cache.put(player_name, version, future.result())
+
+        pool = self._pools[background]
+        try:
+            future = pool.get().submit(render_rating_plot, rating_history, latest_round)
+        except BrokenProcessPool:
+            pool.reset()
+            future = pool.get().submit(render_rating_plot, rating_history, latest_round)
+        future.add_done_callback(on_done)
+        return future
+
+    def render(self, player_name, version, rating_history, latest_round):
+        """Returns the rendered PNG, or None if the queue is full or rendering takes longer than the timeout"""
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            future = self._submit(player_name, version, rating_history, latest_round, background=False)
+        except Exception:
+            self._slots.release()
+            raise
+        try:
+            return future.result(timeout=self.timeout)
+        except (TimeoutError, BrokenProcessPool):
+            return None
+
+    def render_all(self, plots, latest_round):
+        """Renders many plots in the background pool without waiting (e.g. to refill the cache after a
+        recalculation), in the order given. <plots> is a dict {player_name: (version, rating_history)}. Renders still
+        queued from the previous call are cancelled, since these plots supersede them"""
+        for future in self._background_futures:
+            future.cancel()
+        self._background_futures = [self._submit(player_name, version, rating_history, latest_round, background=True)
+                                    for player_name, (version, rating_history) in plots.items()]
@@ -0,0 +1,30 @@
+"""Process pools for the CPU-bound work kept off the request threads (plots, forecasts and backtests). They spawn
+their processes, since forking a (possibly threaded) web worker isn't safe"""
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from threading import Lock
+
+
+def spawn_pool(max_workers):
+    """Returns a ProcessPoolExecutor of <max_workers> (None = number of cores) spawned processes"""
+    return ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+class LazyPool:
+    """A spawned process pool, started on first use and shared by the threads of a web worker"""
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._pool = None
+        self._lock = Lock()
+
+    def get(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = spawn_pool(self.max_workers)
+            return self._pool
+
+    def reset(self):
+        """Drops the pool after it broke (a process died), so the next get starts a new one"""
+        with self._lock:
+            self._pool = None
@@ -0,0 +1,104 @@
+"""Monte Carlo forecast of the next round: each player's chances of finishing in each place of their game, of winning
+the title and of moving up or down a group, assuming the latest round's line-ups play again at current ratings.
+Finishing orders are sampled with the Plackett-Luce model (each place goes to one of the remaining players with
+probability proportional to 10 ** (rating / C)), whose pairwise win probabilities are exactly those of
+expected_matrix. All games and simulations are sampled at once with the Gumbel-max trick, with no per-game loop"""
+from concurrent.futures.process import BrokenProcessPool
+import os
+from threading import Lock
+
+import numpy as np
+
+from constants import C, SIMULATION_BATCH_SIZE, GROUP_MOVES
+from elo import pad_games
+from pools import LazyPool
+
+
+def sample_places(ratings, mask, num_simulations, rng):
+    """Returns a (simulations x games x max_players) array of sampled finishing places (0 = first) from padded
+    (games x max_players) arrays of ratings and real entries"""
+    # Sorting log-strengths plus Gumbel noise gives a Plackett-Luce order; padded entries (-inf) finish last
+    log_strengths = np.where(mask, ratings * (np.log(10) / C), -np.inf)
+    keys = log_strengths + rng.gumbel(size=(num_simulations, *ratings.shape))
+    return (keys[..., np.newaxis, :] > keys[..., :, np.newaxis]).sum(axis=-1)
+
+
+def count_places(ratings, mask, num_simulations, seed):
+    """Returns a (games x max_players x max_players) array counting how often each entry finished in each place,
+    sampled in batches of SIMULATION_BATCH_SIZE simulations"""
+    rng = np.random.default_rng(seed)
+    num_entries, max_players = ratings.size, ratings.shape[-1]
+    offsets = (np.arange(num_entries) * max_players).reshape(ratings.shape)
+    counts = np.zeros(num_entries * max_players, dtype=np.int64)
+    for start in range(0, num_simulations, SIMULATION_BATCH_SIZE):
+        places = sample_places(ratings, mask, min(SIMULATION_BATCH_SIZE, num_simulations - start), rng)
+        counts += np.bincount((offsets + places).ravel(), minlength=counts.size)
+    return counts.reshape(*ratings.shape, max_players)
+
+
+def summarise_forecast(lineups, place_probabilities):
+    """Returns [(group, [player odds])] from the line-ups and the (games x max_players x max_players) finishing
+    place probabilities. Each player's odds are a dict sorted by their chance of winning the game"""
+    forecast = []
+    for (group, players), game_probabilities in zip(lineups, place_probabilities):
+        moves = GROUP_MOVES.get(group, {})
+        odds = []
+        for (name, rating), probabilities in zip(players, game_probabilities):
+            places = probabilities[:len(players)].tolist()
+            odds.append({
+                "name": name,
+                "rating": rating,
+                "places": places,
+                **{move: sum(places[place - 1] for place in moves.get(move, []) if place <= len(players))
+                   for move in ["title", "up", "down"]},
+            })
+        forecast.append((group, sorted(odds, key=lambda player: player["places"], reverse=True)))
+    return forecast
+
+
+class RoundSimulator:
+    """Runs the next-round forecast in-process, or split across a process pool for runs over <parallel_threshold>
+    simulations, and keeps the forecast for the latest league version"""
+
+    def __init__(self, max_workers, parallel_threshold):
+        self.max_workers = max_workers or os.cpu_count()
+        self.parallel_threshold = parallel_threshold
+        self._forecast = None  # (version, num_simulations, forecast)
+        self._forecast_lock = Lock()
+        self._pool = LazyPool(self.max_workers)
+
+    def count_places(self, ratings, mask, num_simulations, seed=None):
+        """Returns the finishing place counts (see count_places), splitting large runs across the pool with an
+        independent random stream per chunk"""
+        seed_sequence = np.random.SeedSequence(seed)
+        if num_simulations <= self.parallel_threshold or self.max_workers == 1:
+            return count_places(ratings, mask, num_simulations, seed_sequence)
+
+        chunk_sizes = [len(chunk) for chunk in np.array_split(np.arange(num_simulations), self.max_workers)]
+        chunk_seeds = seed_sequence.spawn(len(chunk_sizes))
+        try:
+            futures = [self._pool.get().submit(count_places, ratings, mask, chunk_size, chunk_seed)
+                       for chunk_size, chunk_seed in zip(chunk_sizes, chunk_seeds)]
+            return sum(future.result() for future in futures)
+        except BrokenProcessPool:
+            self._pool.reset()
+            return count_places(ratings, mask, num_simulations, seed_sequence)
+
+    def forecast(self, lineups, num_simulations, seed=None):
+        """Returns the forecast [(group, [player odds])] for line-ups [(group, [(name, rating)])]"""
+        if not lineups:
+            return []
+        ratings, mask = pad_games([[rating for name, rating in players] for group, players in lineups])
+        counts = self.count_places(ratings, mask, num_simulations, seed)
+        return summarise_forecast(lineups, counts / num_simulations)
+
+    def get_forecast(self, version, load_lineups, num_simulations):
+        """Returns the forecast for the league version, running it on the first request after the version changes.
+        <load_lineups> returns (latest round, line-ups) and is only called on a miss. The version is the seed, so
+        every worker shows the same odds"""
+        with self._forecast_lock:
+            if self._forecast is None or self._forecast[:2] != (version, num_simulations):
+                latest_round, lineups = load_lineups()
+                forecast = self.forecast(lineups, num_simulations, seed=version)
+                self._forecast = (version, num_simulations, (latest_round, forecast))
+            return self._forecast[2]
@@ -0,0 +1,311 @@
+"""Immutable in-process snapshot of the league: players, factions, games, entries, standings and the derived stats the
+public pages show, as compact read-only records. Each worker loads it once per league version (see SnapshotHolder)
+and the public routes read it without any SQL, so a request costs one league version check"""
+from bisect import bisect_left, bisect_right
+from itertools import groupby
+from threading import Lock
+
+import numpy as np
+
+from constants import STARTING_RATING
+from database_manager import get_snapshot_rows, build_profile_data
+from faction_analytics import FactionAnalytics
+from game_columns import GameColumns, player_stats_table
+from head_to_head import tally_head_to_head
+
+
+# Records
+class Record:
+    """Base of the snapshot records: __slots__ only, set once when the snapshot is built and read-only after"""
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name, None)!r}" for name in self.__slots__[:3])
+        return f"{type(self).__name__}({fields})"
+
+
+def link(record, name, value):
+    """Sets a back-reference on a record while the snapshot is being built"""
+    object.__setattr__(record, name, value)
+
+
+class PlayerRecord(Record):
+    # <games> are in reverse play order, <rating_history> is [(round_num, rating)] from the starting rating
+    __slots__ = ("id", "name", "current_rating", "stats", "group_stats", "faction_stats", "games", "rating_history",
+                 "history_version")
+
+
+class FactionRecord(Record):
+    __slots__ = ("id", "name", "color", "current_rating", "num_games", "rating_history")
+
+
+class GameRecord(Record):
+    # <included> are the game's entries, best score first (like Game.included)
+    __slots__ = ("bga_id", "round", "group", "map", "num_players", "included")
+
+
+class EntryRecord(Record):
+    __slots__ = ("id", "game", "player", "faction", "bid", "score", "old_rating", "new_rating")
+
+
+class PlayerStatsRecord(Record):
+    __slots__ = ("num_games", "score_sum", "bid_sum", "relative_score_sum", "high_rating")
+
+
+class GroupStatsRecord(Record):
+    __slots__ = ("group", "first", "second", "third", "total")
+
+
+class FactionStatsRecord(Record):
+    __slots__ = ("faction", "num_games")
+
+
+# Snapshot
+class LeagueSnapshot:
+    """The league data at one version, built from get_snapshot_rows. Its methods are the only read path of the public
+    pages; the records have the model attributes the templates read (player.name, game.included, entry.faction...)"""
+    __slots__ = ("version", "players", "ranked_players", "factions", "ranked_factions", "games", "game_rounds",
+                 "standings", "checkpoint_rounds", "movers", "results_revisions", "groups", "head_to_head",
+                 "faction_analytics")
+
+    def __init__(self, version, rows):
+        self.version = version
+
+        # Players and factions, by name and in rating order
+        factions = {row.id: FactionRecord(*row) for row in rows["factions"]}
+        players = {row.id: PlayerRecord(*row) for row in rows["players"]}
+        self.factions = {faction.name: faction for faction in factions.values()}
+        self.ranked_factions = tuple(sorted(factions.values(), key=lambda faction: (-faction.current_rating,
+                                                                                     faction.name)))
+        self.players = {player.name: player for player in players.values()}
+        self.ranked_players = tuple(sorted(players.values(), key=lambda player: -player.current_rating))
+
+        # Games and their entries, linked both ways
+        games = {row.bga_id: GameRecord(*row) for row in rows["games"]}
+        player_entries = {player_id: [] for player_id in players}
+        faction_games = dict.fromkeys(factions, 0)
+        for game_id, game_rows in groupby(rows["entries"], key=lambda row: row.game_id):
+            game = games[game_id]
+            entries = tuple(EntryRecord(entry_id, game, players[player_id], factions[faction_id], *values)
+                            for entry_id, game_id, player_id, faction_id, *values in game_rows)
+            link(game, "included", entries)
+            for entry in entries:
+                player_entries[entry.player.id].append(entry)
+                faction_games[entry.faction.id] += 1
+        for game in games.values():
+            if not hasattr(game, "included"):
+                link(game, "included", ())
+        self.games = tuple(games.values())  # By round and group
+        self.game_rounds = tuple(game.round for game in self.games)
+        latest_round = self.game_rounds[-1] if self.games else None
+
+        # Every player's stats at once from the columnar history (players are in id order, like the columns)
+        columns = GameColumns([(game.bga_id, entry.player.id, entry.faction.id, game.round, game.group, game.map,
+                                game.num_players, entry.bid, entry.score, entry.new_rating)
+                               for game in self.games for entry in game.included], list(players), list(factions))
+        table = {name: values.tolist() for name, values in player_stats_table(columns).items()}
+        self.groups = tuple(columns.groups.tolist())
+        self.faction_analytics = FactionAnalytics(columns, [faction.name for faction in factions.values()])
+        faction_records = list(factions.values())
+
+        # Per-player stats, games and rating history
+        for i, (player_id, player) in enumerate(players.items()):
+            entries = player_entries[player_id]
+            history = sorted((entry.game.round, entry.new_rating) for entry in entries)
+            high_rating = table["high_rating"][i]
+            link(player, "stats", PlayerStatsRecord(table["num_games"][i], table["score_sum"][i], table["bid_sum"][i],
+                                                    table["relative_score_sum"][i],
+                                                    high_rating if high_rating >= 0 else None))
+            link(player, "group_stats", tuple(GroupStatsRecord(group, *placements) for group, placements
+                                              in zip(self.groups, table["placements"][i]) if placements[-1]))
+            link(player, "faction_stats", tuple(FactionStatsRecord(faction, num_games) for faction, num_games
+                                                in zip(faction_records, table["faction_games"][i]) if num_games))
+            link(player, "games", tuple(entry.game for entry in sorted(entries, key=lambda entry: (-entry.game.round,
+                                                                                                  -entry.score))))
+            link(player, "rating_history", tuple([(history[0][0] - 1, STARTING_RATING)] + history if history else []))
+            # Changes whenever the player's history or the latest round does (the rating plot cache key)
+            link(player, "history_version", (len(entries), max((entry.id for entry in entries), default=None),
+                                             sum(entry.new_rating for entry in entries) if entries else None,
+                                             latest_round))
+
+        # Faction game counts and rating histories
+        faction_histories = {faction_id: [(row.round, row.rating) for row in faction_rows]
+                             for faction_id, faction_rows in groupby(rows["faction_checkpoints"],
+                                                                     key=lambda row: row.faction_id)}
+        for faction_id, faction in factions.items():
+            link(faction, "num_games", faction_games[faction_id])
+            link(faction, "rating_history", tuple([(0, STARTING_RATING)] + faction_histories.get(faction_id, [])))
+
+        # Standings of each round (players who had played by then) and the latest round's movers
+        names = {player_id: player.name for player_id, player in players.items()}
+        self.standings = {round_num: tuple(sorted(((names[player_id], *values) for _, player_id, *values in round_rows),
+                                                  key=lambda row: (row[3], row[0])))
+                          for round_num, round_rows in groupby(rows["rating_checkpoints"], key=lambda row: row[0])}
+        self.checkpoint_rounds = tuple(self.standings)
+        latest_standings = self.standings[self.checkpoint_rounds[-1]] if self.standings else ()
+        self.movers = tuple(sorted(((name, rating, rating_change, rank) for name, rating, num_games, rank, rating_change
+                                    in latest_standings if rating_change), key=lambda row: (-row[2], row[0])))
+
+        self.results_revisions = tuple(tuple(row) for row in rows["results_revisions"])
+
+        # League-wide (W, L, D) head-to-head matrix, in rating order
+        index = {player.id: i for i, player in enumerate(self.ranked_players)}
+        self.head_to_head = np.zeros((len(index), len(index), 3), dtype=int)
+        tally_head_to_head(self.head_to_head, index, [[(entry.player.id, entry.score) for entry in game.included]
+                                                      for game in self.games if game.included])
+        self.head_to_head.flags.writeable = False
+
+    # Home page
+    def get_leaderboard(self):
+        """Returns (players sorted by rating, {player_name: num_games})"""
+        return list(self.ranked_players), {player.name: player.stats.num_games if player.stats else 0
+                                           for player in self.ranked_players}
+
+    def get_latest_round(self):
+        return self.game_rounds[-1] if self.games else None
+
+    def get_latest_games(self):
+        """Returns the games of the latest round, by group"""
+        latest_round = self.get_latest_round()
+        return self.games[bisect_left(self.game_rounds, latest_round):] if self.games else ()
+
+    def get_latest_results(self):
+        """Returns the latest round's results as {group: entries}"""
+        return {game.group: game.included for game in self.get_latest_games()}
+
+    def get_latest_lineups(self):
+        """Returns (latest round, [(group, [(name, current rating)])]), one line-up per game of the latest round"""
+        lineups = [(game.group, sorted((entry.player.name, entry.player.current_rating) for entry in game.included))
+                   for game in self.get_latest_games() if game.included]
+        return self.get_latest_round() if lineups else None, lineups
+
+    def get_movers(self, num_movers):
+        """Returns (latest round, biggest risers, biggest fallers) of the latest round's standings, each a list of
+        (name, rating, rating_change, rank)"""
+        if not self.movers:
+            return None, [], []
+        risers = [row for row in self.movers if row[2] > 0][:num_movers]
+        fallers = [row for row in reversed(self.movers) if row[2] < 0][:num_movers]
+        return self.checkpoint_rounds[-1], risers, fallers
+
+    # Results pages
+    def get_round_range(self):
+        """Returns (first round, latest round), both None if no games have been played"""
+        return (self.game_rounds[0], self.game_rounds[-1]) if self.games else (None, None)
+
+    def get_results_revision(self, last_round):
+        """Returns the league version at which results up to <last_round> were last rewritten (0 if never)"""
+        return max((version for version, after_round in self.results_revisions
+                    if after_round is None or after_round < last_round), default=0)
+
+    def get_results_page(self, first_round, last_round):
+        """Returns the results of rounds <first_round> to <last_round> as {round_num: {group: entries}}"""
+        results = {}
+        for game in self.games[bisect_left(self.game_rounds, first_round):bisect_right(self.game_rounds, last_round)]:
+            results.setdefault(game.round, {})[game.group] = game.included
+        return results
+
+    # Players
+    def get_profile_data(self, player_name):
+        """Returns (player, profile_data, game_history) (see build_profile_data), or None if there is no such
+        player"""
+        player = self.players.get(player_name)
+        if player is None:
+            return None
+        return (player, *build_profile_data(player, player.games, self.groups))
+
+    def get_rating_history(self, player_name):
+        """Returns [(round_num, rating)] for the named player, from their starting rating"""
+        return list(self.players[player_name].rating_history)
+
+    def get_rating_history_version(self, player_name):
+        """Returns the player's rating history version, or None if they don't exist"""
+        player = self.players.get(player_name)
+        return None if player is None else player.history_version
+
+    def get_all_rating_histories(self, player_names=None, since_round=None):
+        """Returns {player_name: [(round_num, rating)]} for every player who has played, optionally only for the
+        given player names and/or from <since_round> on (without the starting rating point)"""
+        names = sorted(self.players if player_names is None else set(player_names) & self.players.keys())
+        rating_histories = {}
+        for name in names:
+            history = self.players[name].rating_history
+            if since_round is not None:
+                history = [(round_num, rating) for round_num, rating in history[1:] if round_num >= since_round]
+            if history:
+                rating_histories[name] = list(history)
+        return rating_histories
+
+    def get_rating_history_versions(self):
+        """Returns {player_name: rating history version} for every player"""
+        return {name: player.history_version for name, player in self.players.items()}
+
+    def get_recently_active_players(self, limit):
+        """Returns the names of up to <limit> players who have played, most recent latest game first"""
+        active = sorted((player for player in self.players.values() if player.games),
+                        key=lambda player: (-player.games[0].round, player.name))
+        return [player.name for player in active[:limit]]
+
+    def get_head_to_head_record(self, player):
+        """Returns {other_player_name: [W, L, D]} covering every other player, in rating order"""
+        row = self.head_to_head[self.ranked_players.index(player)]
+        return {other.name: row[i].tolist() for i, other in enumerate(self.ranked_players) if other is not player}
+
+    def get_head_to_head_table(self):
+        """Returns (player names sorted by rating, players x players x [W, L, D] matrix in that order)"""
+        return [player.name for player in self.ranked_players], self.head_to_head
+
+    # Standings
+    def get_standings(self, round_num):
+        """Returns the standings at the end of a round as [(name, rating, num_games, rank, rating_change)]"""
+        return list(self.standings.get(round_num, ()))
+
+    def get_adjacent_rounds(self, round_num):
+        """Returns (previous round, next round) that have standings, either None if there isn't one"""
+        previous_index = bisect_left(self.checkpoint_rounds, round_num)
+        next_index = bisect_right(self.checkpoint_rounds, round_num)
+        return (self.checkpoint_rounds[previous_index - 1] if previous_index else None,
+                self.checkpoint_rounds[next_index] if next_index < len(self.checkpoint_rounds) else None)
+
+    # Factions
+    def get_faction_leaderboard(self):
+        """Returns [(faction, num_games)] sorted by faction rating"""
+        return [(faction, faction.num_games) for faction in self.ranked_factions]
+
+    def get_faction_rating_history(self, faction_name):
+        """Returns [(round_num, rating)] for the named faction from round 0, or None if there is no such faction"""
+        faction = self.factions.get(faction_name)
+        return None if faction is None else list(faction.rating_history)
+
+
+def load_snapshot(db):
+    """Returns a LeagueSnapshot of the current league data, tagged with the version it was read at. That can be newer
+    than the version the request saw, in which case the next request's check finds it current"""
+    return LeagueSnapshot(*get_snapshot_rows(db))
+
+
+class SnapshotHolder:
+    """Keeps this worker's LeagueSnapshot and swaps in a new one when a request sees a different league version.
+    One thread loads it while the others wait for it; readers keep whichever snapshot they already hold"""
+
+    def __init__(self):
+        self._snapshot = None
+        self._lock = Lock()
+
+    def get(self, db, version):
+        """Returns the snapshot for the league <version> (just checked by the caller), loading it if needed"""
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != version:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot.version != version:
+                    snapshot = load_snapshot(db)
+                    self._snapshot = snapshot
+        return snapshot
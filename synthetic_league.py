@@ -0,0 +1,103 @@
+"""Fills the database with a deterministic synthetic league for benchmarking, e.g.
+python synthetic_league.py --db sqlite:///bench.db --players 500 --rounds 200 --entries 50000 --reset"""
+import argparse
+import datetime as dt
+import os
+import random
+
+from sqlalchemy import insert, delete
+
+from constants import FACTIONS, MAPS, EMOJIS, STARTING_RATING
+
+GAME_ID_START = 100_000_000
+CREATED_AT = dt.datetime(2024, 1, 1)
+
+
+def synthetic_games(num_players, num_rounds, num_entries, seed=0):
+    """Returns a list of game dicts (in the importer's format) for a synthetic league. Each round a random
+    <num_entries> / <num_rounds> players are seated at tables of 3-5, strongest first, and the tables are split
+    evenly between the groups. Scores come from a hidden skill per player plus noise, so ratings spread out"""
+    rng = random.Random(seed)
+    player_names = [f"P{i:04d}" for i in range(num_players)]
+    skills = {name: rng.gauss(0, 15) for name in player_names}
+    map_names = [map_name for map_name, label in MAPS]
+    groups = sorted(EMOJIS)
+    players_per_round = max(2, min(num_players, round(num_entries / num_rounds)))
+
+    games = []
+    for round_num in range(1, num_rounds + 1):
+        seated = sorted(rng.sample(player_names, players_per_round), key=lambda name: -skills[name])
+        tables = []
+        while seated:
+            size = len(seated) if len(seated) <= 5 else rng.choice([3, 4, 4, 4, 5])
+            if 0 < len(seated) - size < 2:
+                size -= 1
+            tables.append(seated[:size])
+            seated = seated[size:]
+
+        for table_num, table in enumerate(tables):
+            entries = [{"player": name, "faction": faction, "bid": rng.choice([0, 0, 0, 1, 2, 3, 5, 8]),
+                        "score": max(0, min(250, round(120 + skills[name] + rng.gauss(0, 20))))}
+                       for name, faction in zip(table, rng.sample(FACTIONS, len(table)))]
+            games.append({"bga_id": GAME_ID_START + len(games), "round": round_num,
+                          "group": groups[table_num * len(groups) // len(tables)], "map": rng.choice(map_names),
+                          "entries": entries})
+    return player_names, games
+
+
+def generate_league(db, num_players=500, num_rounds=200, num_entries=50_000, seed=0, chunk_size=10_000):
+    """Replaces the league data with a synthetic league and calculates its ratings. Users are kept"""
+    from database_manager import (Player, Faction, Game, GameHistory, RatingCheckpoint, FactionCheckpoint,
+                                  bulk_insert_rows)
+    from elo import recalculate_elos
+
+    player_names, games = synthetic_games(num_players, num_rounds, num_entries, seed)
+    rng = random.Random(seed)
+
+    for table in [RatingCheckpoint, FactionCheckpoint, GameHistory, Game, Player, Faction]:
+        db.session.execute(delete(table))
+    db.session.execute(insert(Player), [{"name": name, "current_rating": STARTING_RATING} for name in player_names])
+    db.session.execute(insert(Faction), [{"name": name, "current_rating": STARTING_RATING,
+                                          "color": ", ".join(str(rng.randrange(256)) for i in range(3))}
+                                         for name in FACTIONS])
+    player_ids = dict(db.session.execute(db.select(Player.name, Player.id)).all())
+    faction_ids = dict(db.session.execute(db.select(Faction.name, Faction.id)).all())
+
+    bulk_insert_rows(db, Game, [{"bga_id": game["bga_id"], "round": game["round"], "group": game["group"],
+                                 "map": game["map"], "num_players": len(game["entries"])} for game in games])
+    entry_rows = [{"player_id": player_ids[entry["player"]], "faction_id": faction_ids[entry["faction"]],
+                   "game_id": game["bga_id"], "bid": entry["bid"], "score": entry["score"],
+                   "old_rating": STARTING_RATING, "new_rating": STARTING_RATING, "created_at": CREATED_AT}
+                  for game in games for entry in game["entries"]]
+    for start in range(0, len(entry_rows), chunk_size):
+        bulk_insert_rows(db, GameHistory, entry_rows[start:start + chunk_size])
+
+    recalculate_elos(db)
+    return len(games), len(entry_rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill a database with a deterministic synthetic league")
+    parser.add_argument("--db", default=os.environ.get("DB_URI", "sqlite:///bench.db"),
+                        help="database URI (SQLite or Postgres), default $DB_URI or sqlite:///bench.db")
+    parser.add_argument("--players", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--entries", type=int, default=50_000, help="approximate number of game_history rows")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reset", action="store_true", help="required, since all league data is replaced")
+    args = parser.parse_args()
+    if not args.reset:
+        parser.error(f"this replaces all league data in {args.db}, pass --reset to confirm")
+
+    # The app reads its database from the environment when it is imported
+    os.environ["DB_URI"] = args.db
+    from main import app
+    from database_manager import db
+
+    with app.app_context():
+        num_games, num_entries = generate_league(db, args.players, args.rounds, args.entries, args.seed)
+    print(f"Generated {args.players} players, {args.rounds} rounds, {num_games} games, {num_entries} entries")
+
+
+if __name__ == "__main__":
+    main()